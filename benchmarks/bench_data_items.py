@@ -0,0 +1,111 @@
+"""Benchmark of the data item metadata handling on large result sets.
+
+Usage:
+    python benchmarks/bench_data_items.py [--n-items N]
+
+Times the member filtering of CMIP6APISearcher (max_number_of_members)
+and the lookup of the local file of every data item on a synthetic
+result set of N data items (default 100000). For comparison, the
+previous implementation, which parsed the filename on every access to
+metadata and filtered the members model by model, is timed as well.
+
+"""
+import argparse
+import time
+import tracemalloc
+
+from cmip6download import helper
+from cmip6download.data_item import CMIP6DataItem
+from cmip6download.searcher import CMIP6APISearcher
+
+
+def synthetic_data_items(n_items, n_models=100, n_members=7):
+    data_items = []
+    for i in range(n_items):
+        member = f'r{i % n_members + 1}i1p1f1'
+        filename = (
+            f'tas_Amon_MODEL{i % n_models}_historical_{member}_gn_'
+            f'{1850 + i % 100}01-{1850 + i % 100}12.nc')
+        data_items.append(CMIP6DataItem(
+            filename=filename,
+            local_base_dir='/data/cmip6',
+            file_urls=[f'http://esgf-data.example.org/{filename}'],
+            remote_checksum=f'{i:064x}',
+            remote_checksum_type='SHA256'))
+    return data_items
+
+
+def legacy_filter_data_items(data_items, max_number_of_members):
+    """Member filtering as implemented before (for comparison)."""
+    def metadata(d):
+        return dict(zip(
+            helper.METADATA_FILENAME_LIST,
+            d.filename.split('.')[0].split('_')))
+
+    unq_models = list({metadata(d)['source_id'] for d in data_items})
+    all_model_data_items = []
+    for model in unq_models:
+        model_data_items = [
+            d for d in data_items if metadata(d)['source_id'] == model]
+        unq_members = list({metadata(d)['member_id'] for d in model_data_items})
+        if max_number_of_members < len(unq_members):
+            selected_members = helper.sort_member_id_str(
+                unq_members)[:max_number_of_members]
+            model_data_items = [
+                d for d in model_data_items
+                if metadata(d)['member_id'] in selected_members]
+        all_model_data_items.extend(model_data_items)
+    return all_model_data_items
+
+
+def legacy_local_files(data_items):
+    return [
+        helper.get_local_dir(d.filename, d.local_base_dir) / d.filename
+        for d in data_items]
+
+
+def timed(func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - t0, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--n-items', type=int, default=100000)
+    parser.add_argument('--max-number-of-members', type=int, default=3)
+    args = parser.parse_args()
+
+    searcher = CMIP6APISearcher('http://esgf.example.org', '/data/cmip6')
+    data_items = synthetic_data_items(args.n_items)
+    t_legacy_filter, legacy_result = timed(
+        legacy_filter_data_items, data_items, args.max_number_of_members)
+    t_legacy_files, _ = timed(legacy_local_files, data_items)
+
+    data_items = synthetic_data_items(args.n_items)
+    t_filter, result = timed(lambda: searcher._filter_data_items(
+        data_items, None, max_number_of_members=args.max_number_of_members))
+    t_files, _ = timed(lambda: [d.local_file for d in data_items])
+    t_files_cached, _ = timed(lambda: [d.local_file for d in data_items])
+    assert len(result) == len(legacy_result)
+
+    print(f'{len(data_items)} data items, {len(result)} after filtering')
+    print(f'{"":<22} {"legacy [s]":>10} {"current [s]":>12}')
+    print(f'{"member filtering":<22} {t_legacy_filter:>10.3f} '
+          f'{t_filter:>12.3f}')
+    print(f'{"local files":<22} {t_legacy_files:>10.3f} {t_files:>12.3f}')
+    print(f'{"local files (again)":<22} {t_legacy_files:>10.3f} '
+          f'{t_files_cached:>12.3f}')
+
+    # Memory of the parsed metadata of all data items
+    data_items = synthetic_data_items(args.n_items)
+    tracemalloc.start()
+    metadata = [d.metadata for d in data_items]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracemalloc.start()
+    legacy_metadata = [
+        helper.get_metadata_from_filename(d.filename) for d in data_items]
+    legacy_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{"metadata [MB]":<22} {legacy_size/1e6:>10.1f} {size/1e6:>12.1f}')
@@ -0,0 +1,145 @@
+"""Benchmark of searching and downloading against a fake ESGF.
+
+Usage:
+    python benchmarks/bench_esgf.py [--n-files N] [--file-size MB] ...
+
+Starts a local fake index node and --n-replicas data nodes (see
+benchmarks/fake_esgf.py, which also lists the options to slow them
+down or make them unreliable) and measures
+
+- the search of all files with CMIP6APISearcher for every response
+  parser (search time and the time spent parsing the responses,
+  summed over all parallel requests), and
+- the download of all found files with the DownloadScheduler and
+  --n-worker processes, as the cmip6download command does (files/s
+  and MB/s).
+
+The results are printed to stdout, log messages to stderr.
+
+Example (two replicas, one of them slow and unreliable):
+    python benchmarks/bench_esgf.py --n-files 500 --file-size 2 \\
+        --latency 0.01 0.2 --bandwidth 0 5 --failure-rate 0 0.2
+
+"""
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+
+from cmip6download import host_health
+from cmip6download import metrics
+from cmip6download import response_parser
+from cmip6download.data_item import DownloadSettings
+from cmip6download.query import CMIP6APIQuery
+from cmip6download.scheduler import DownloadResult, DownloadScheduler
+from cmip6download.searcher import CMIP6APISearcher
+
+import fake_esgf
+
+
+def search(search_url, base_data_dir, queries, args, parser_name):
+    """Return (search time, parse time, number of requests, data items)."""
+    metrics.reset_metrics()
+    searcher = CMIP6APISearcher(
+        search_url, base_data_dir, n_search_workers=args.n_search_workers,
+        search_page_size=args.search_page_size,
+        search_response_parser=parser_name)
+    t0 = time.perf_counter()
+    # The searcher prints every API call
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = searcher.get_data_items_concurrently(queries)
+    search_time = time.perf_counter() - t0
+    snapshot = metrics.get_metrics().snapshot()
+    parse_time = snapshot['histograms'].get(
+        ('search_parse_seconds', ()), [0, 0])[-2]
+    n_requests = sum(
+        value for (name, _), value in snapshot['counters'].items()
+        if name == 'search_requests_total')
+    data_items = [di for _, data_items in results for di in data_items]
+    return search_time, parse_time, n_requests, data_items
+
+
+def download_job(i, data_item, max_attempts, settings, host=None):
+    if host is not None:
+        data_item.restrict_to_host(host)
+    local_file = data_item.download(
+        max_attempts=max_attempts, settings=settings, defer_retries=True)
+    return DownloadResult(
+        index=i, filename=data_item.filename,
+        verified=local_file is not None, transfers=data_item._transfers,
+        retry_after=data_item.retry_after, retry_host=data_item.retry_host,
+        rotation=data_item._rotation)
+
+
+def download(data_items, args):
+    """Return (download time, number of failed files, received bytes)."""
+    threshold = args.segmented_download_threshold
+    settings = DownloadSettings(
+        segmented_download_threshold=(
+            None if threshold is None else int(threshold * 1024**2)),
+        n_download_segments=args.n_download_segments)
+    scheduler = DownloadScheduler(args.n_worker, download_job)
+    for i, data_item in enumerate(data_items):
+        scheduler.add(
+            0, i, data_item, args.max_download_attempts, settings,
+            hosts=[host_health.get_host(u) for u in data_item.file_urls])
+    n_failed = n_bytes = 0
+    t0 = time.perf_counter()
+    for result in scheduler.run():
+        n_bytes += sum(t[1] for t in result.transfers)
+        if result.retry_after is not None:
+            data_item = data_items[result.index]
+            data_item._rotation = result.rotation
+            scheduler.add(
+                0, result.index, data_item, args.max_download_attempts,
+                settings, hosts=[result.retry_host],
+                not_before=time.monotonic() + result.retry_after)
+            continue
+        n_failed += not result.verified
+    return time.perf_counter() - t0, n_failed, n_bytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    fake_esgf.add_arguments(parser)
+    parser.add_argument(
+        '--parser', nargs='+', default=list(response_parser.RESPONSE_PARSERS),
+        choices=list(response_parser.RESPONSE_PARSERS),
+        help='Response parsers whose search is timed.')
+    parser.add_argument('--n-search-workers', type=int, default=4)
+    parser.add_argument('--search-page-size', type=int, default=1000)
+    parser.add_argument('--n-worker', type=int, default=4)
+    parser.add_argument('--max-download-attempts', type=int, default=3)
+    parser.add_argument(
+        '--segmented-download-threshold', type=float, default=None,
+        help='Files of at least this size (in MB) are downloaded in '
+             'segments.')
+    parser.add_argument('--n-download-segments', type=int, default=4)
+    parser.add_argument(
+        '--no-download', action='store_true', help='Only time the search.')
+    args = parser.parse_args()
+
+    process, search_url = fake_esgf.start_fake_esgf(
+        *fake_esgf.get_fake_esgf_kwargs(args))
+    queries = [
+        CMIP6APIQuery(
+            variable=variable, frequency='mon', experiment_id='historical')
+        for variable in ['tas', 'pr']]
+    with tempfile.TemporaryDirectory() as base_data_dir:
+        print(f'{"parser":<8} {"requests":>8} {"results":>8} '
+              f'{"search [s]":>11} {"parse [s]":>10}')
+        for parser_name in args.parser:
+            search_time, parse_time, n_requests, data_items = search(
+                search_url, base_data_dir, queries, args, parser_name)
+            print(f'{parser_name:<8} {n_requests:>8} {len(data_items):>8} '
+                  f'{search_time:>11.3f} {parse_time:>10.3f}')
+
+        if not args.no_download:
+            download_time, n_failed, n_bytes = download(data_items, args)
+            print(f'\n{"files":>8} {"failed":>8} {"time [s]":>10} '
+                  f'{"files/s":>9} {"MB/s":>9}')
+            print(f'{len(data_items):>8} {n_failed:>8} {download_time:>10.3f} '
+                  f'{len(data_items)/download_time:>9.1f} '
+                  f'{n_bytes/1024**2/download_time:>9.1f}')
+    process.terminate()
@@ -0,0 +1,127 @@
+"""Micro-benchmark of the search response parsers.
+
+Usage:
+    python benchmarks/bench_response_parser.py [--xml FILE] [--json FILE]
+
+FILE is a recorded API response, e.g. obtained with
+    curl 'https://esgf-node.llnl.gov/esg-search/search?type=File&\
+project=CMIP6&variable=tas&limit=10000' > response.xml
+(add &format=application/solr+json for the JSON variant). If no
+recorded responses are given, synthetic responses with --n-docs
+documents are used.
+
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from cmip6download import response_parser
+
+
+def synthetic_docs(n_docs):
+    """Return n_docs documents resembling ESGF File results."""
+    docs = []
+    for i in range(n_docs):
+        member = f'r{i % 10 + 1}i1p1f1'
+        filename = (
+            f'tas_Amon_MODEL{i % 50}_historical_{member}_gn_'
+            f'{1850 + i % 100}01-{1850 + i % 100}12.nc')
+        url = f'http://esgf-data.example.org/thredds/fileServer/{filename}'
+        docs.append({
+            'id': f'CMIP6.CMIP.INST.MODEL{i % 50}.historical.{member}.'
+                  f'Amon.tas.gn.v20190101.{filename}|esgf-data.example.org',
+            'version': '1',
+            'activity_id': ['CMIP'],
+            'checksum': [f'{i:064x}'],
+            'checksum_type': ['SHA256'],
+            'data_node': 'esgf-data.example.org',
+            'dataset_id': f'CMIP6.CMIP.INST.MODEL{i % 50}.historical.'
+                          f'{member}.Amon.tas.gn.v20190101',
+            'experiment_id': ['historical'],
+            'frequency': ['mon'],
+            'grid_label': ['gn'],
+            'institution_id': ['INST'],
+            'member_id': [member],
+            'size': str(1000000 + i),
+            'source_id': [f'MODEL{i % 50}'],
+            'table_id': ['Amon'],
+            'title': filename,
+            'tracking_id': [f'hdl:21.14100/{i:032x}'],
+            'url': [
+                f'{url}|application/netcdf|HTTPServer',
+                f'gsiftp://esgf-data.example.org/{filename}|'
+                'application/gridftp|GridFTP',
+                f'http://esgf-data.example.org/thredds/dodsC/{filename}.html'
+                '|application/opendap-html|OPENDAP'],
+            'variable_id': ['tas'],
+            })
+    return docs
+
+
+def docs_as_xml(docs, num_found=None, start=0):
+    if num_found is None:
+        num_found = len(docs)
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n<response>'
+        '<lst name="responseHeader"><int name="status">0</int></lst>'
+        f'<result name="response" numFound="{num_found}" start="{start}">']
+    for doc in docs:
+        parts.append('<doc>')
+        for k, v in doc.items():
+            if isinstance(v, list):
+                parts.append(f'<arr name="{k}">')
+                parts.extend(f'<str>{x}</str>' for x in v)
+                parts.append('</arr>')
+            else:
+                parts.append(f'<str name="{k}">{v}</str>')
+        parts.append('</doc>')
+    parts.append('</result></response>')
+    return ''.join(parts).encode()
+
+
+def docs_as_json(docs, num_found=None, start=0):
+    if num_found is None:
+        num_found = len(docs)
+    return json.dumps({
+        'responseHeader': {'status': 0},
+        'response': {'numFound': num_found, 'start': start, 'docs': docs},
+        }).encode()
+
+
+def benchmark(parser, content, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        num_found, docs = parser.parse(content)
+        timings.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    parser.parse(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak, num_found, len(docs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--xml', help='Recorded XML response.')
+    parser.add_argument('--json', help='Recorded Solr JSON response.')
+    parser.add_argument('--n-docs', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    docs = None
+    if args.xml is None or args.json is None:
+        docs = synthetic_docs(args.n_docs)
+    xml_content = (
+        open(args.xml, 'rb').read() if args.xml else docs_as_xml(docs))
+    json_content = (
+        open(args.json, 'rb').read() if args.json else docs_as_json(docs))
+
+    print(f'{"parser":<8} {"size [MB]":>10} {"time [s]":>10} '
+          f'{"peak mem [MB]":>14} {"docs":>8}')
+    for name, p in response_parser.RESPONSE_PARSERS.items():
+        content = json_content if p.response_format else xml_content
+        t, peak, num_found, n_docs = benchmark(p(), content, args.repeat)
+        print(f'{name:<8} {len(content)/1e6:>10.1f} {t:>10.3f} '
+              f'{peak/1e6:>14.1f} {n_docs:>8}')
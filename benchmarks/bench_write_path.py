@@ -0,0 +1,146 @@
+"""Benchmark of the disk write path of downloads.
+
+Usage:
+    python benchmarks/bench_write_path.py [--dir DIR] [--n-files N] ...
+
+Downloads --n-files files of --file-size MB one after another from a
+local fake data node (see benchmarks/fake_esgf.py) into DIR (default:
+a temporary directory; use a directory on the target filesystem, e.g.
+Lustre, for meaningful numbers) and hashes them while writing, with
+
+- the previous write path (iter_content chunks of 128 KiB, one write
+  call per chunk), and
+- file_writer.FileWriter with the given chunk size, buffer size,
+  preallocation and with or without fsync.
+
+Every variant is run --repeat times, the best throughput is reported
+together with the number of write calls per file. On fast local disks
+the fake data node (a Python HTTP server) may limit the throughput.
+
+Since all files are downloaded one after another from the same data
+node, every variant must reuse a single keep-alive connection; the
+benchmark fails if a variant opens more connections.
+
+"""
+import argparse
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+import time
+
+from cmip6download import file_writer
+from cmip6download import http_session
+
+import fake_esgf
+
+
+LEGACY_CHUNK_SIZE = 128 * 1024
+
+
+def legacy_download(url, path):
+    """Write path as implemented before (for comparison)."""
+    checksum_hash = hashlib.sha256()
+    n_writes = 0
+    with http_session.get_session().get(url, stream=True) as r, \
+            open(path, 'wb') as f:
+        for chunk in r.iter_content(LEGACY_CHUNK_SIZE):
+            f.write(chunk)
+            checksum_hash.update(chunk)
+            n_writes += 1
+    return checksum_hash.hexdigest(), n_writes
+
+
+def file_writer_download(
+        url, path, chunk_size, buffer_size, preallocate, fsync):
+    checksum_hash = hashlib.sha256()
+    with http_session.get_session().get(url, stream=True) as r:
+        size = int(r.headers['Content-Length']) if preallocate else None
+        readinto = file_writer.get_readinto(r)
+        with file_writer.FileWriter(
+                path, 'wb', size=size, buffer_size=buffer_size,
+                checksum_hash=checksum_hash, fsync=fsync) as f:
+            while f.readinto(readinto, chunk_size):
+                pass
+            file_writer.release_connection(r)
+            f.close(complete=True)
+    return checksum_hash.hexdigest(), -(-f.n_bytes // buffer_size)
+
+
+def get_n_connections():
+    return http_session.get_stats().get('total', {}).get('connections', 0)
+
+
+def benchmark(download, urls, checksums, directory, repeat, **kwargs):
+    """Return (best throughput in MB/s, write calls per file)."""
+    best = 0
+    n_connections = get_n_connections()
+    for _ in range(repeat):
+        paths = [directory / os.path.basename(url) for url in urls]
+        t0 = time.perf_counter()
+        for url, path, checksum in zip(urls, paths, checksums):
+            result, n_writes = download(url, path, **kwargs)
+            assert result == checksum
+        duration = time.perf_counter() - t0
+        n_bytes = sum(path.stat().st_size for path in paths)
+        best = max(best, n_bytes / 1024**2 / duration)
+        for path in paths:
+            path.unlink()
+    n_connections = get_n_connections() - n_connections
+    assert n_connections <= 1, (
+        f'{n_connections} connections opened for {repeat * len(urls)} '
+        'sequential downloads (the connections are not reused).')
+    return best, n_writes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dir', help='Directory of the downloaded files.')
+    parser.add_argument('--n-files', type=int, default=8)
+    parser.add_argument(
+        '--file-size', type=float, default=64, help='File size in MB.')
+    parser.add_argument(
+        '--chunk-size', type=int, nargs='+',
+        default=[file_writer.DEFAULT_CHUNK_SIZE // 1024],
+        help='Chunk sizes in KiB.')
+    parser.add_argument(
+        '--buffer-size', type=float, nargs='+',
+        default=[file_writer.DEFAULT_BUFFER_SIZE / 1024**2],
+        help='Buffer sizes in MB.')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    archive_kwargs = {
+        'n_files': args.n_files, 'file_size': int(args.file_size * 1024**2)}
+    process, search_url = fake_esgf.start_fake_esgf(
+        archive_kwargs, [fake_esgf.DataNodeSettings()])
+    docs = http_session.get_session().get(search_url, params={
+        'format': 'application/solr+json', 'limit': args.n_files,
+        }).json()['response']['docs']
+    urls = [doc['url'][0].split('|')[0] for doc in docs]
+    checksums = [doc['checksum'][0] for doc in docs]
+
+    variants = [('legacy (128 KiB chunks)', legacy_download, {})]
+    for chunk_size in args.chunk_size:
+        for buffer_size in args.buffer_size:
+            for preallocate, fsync in [
+                    (False, False), (True, False), (True, True)]:
+                name = (
+                    f'FileWriter ({chunk_size} KiB, {buffer_size:g} MB'
+                    f'{", prealloc" if preallocate else ""}'
+                    f'{", fsync" if fsync else ""})')
+                variants.append((name, file_writer_download, {
+                    'chunk_size': chunk_size * 1024,
+                    'buffer_size': int(buffer_size * 1024**2),
+                    'preallocate': preallocate, 'fsync': fsync}))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        print(f'{args.n_files} files of {args.file_size:g} MB in '
+              f'{directory}')
+        print(f'{"write path":<44} {"MB/s":>8} {"writes/file":>12}')
+        for name, download, kwargs in variants:
+            throughput, n_writes = benchmark(
+                download, urls, checksums, Path(directory), args.repeat,
+                **kwargs)
+            print(f'{name:<44} {throughput:>8.1f} {n_writes:>12}')
+    process.terminate()
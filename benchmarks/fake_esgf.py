@@ -0,0 +1,401 @@
+"""Local stand-in for an ESGF index node and its data nodes.
+
+Usage:
+    python benchmarks/fake_esgf.py [--n-files N] [--file-size MB] ...
+
+Serves the search API (Solr XML, or JSON with
+format=application/solr+json) of a synthetic CMIP6 archive and the
+files of this archive from --n-replicas data nodes. Every data node
+listens on its own port, so that it is a separate host for the host
+health table. The content of every file is generated on the fly from
+a random block, its SHA256 checksum in the search results is correct.
+
+The data nodes support HEAD and Range requests (unless --no-range) and
+can be slowed down and made unreliable (see DataNodeSettings).
+
+The server can also be started from another script (see
+start_fake_esgf), e.g. by benchmarks/bench_esgf.py.
+
+"""
+import argparse
+from dataclasses import dataclass
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+import random
+import threading
+import time
+import urllib.parse
+
+from bench_response_parser import docs_as_json, docs_as_xml
+
+
+BLOCK_SIZE = 1024**2
+CHUNK_SIZE = 64 * 1024
+SEARCH_PATH = '/esg-search/search'
+FILE_PATH = '/thredds/fileServer/'
+# Search parameters which filter the results (all others are ignored)
+FACETS = [
+    'variable', 'variable_id', 'frequency', 'experiment_id', 'source_id',
+    'member_id', 'grid_label', 'table_id', 'activity_id']
+
+
+@dataclass
+class DataNodeSettings:
+    """Behaviour of a single fake data node.
+
+    Attributes:
+        latency (float): Seconds before every response is sent.
+        bandwidth (float): Bytes per second of every connection (None
+            for no limit).
+        failure_rate (float): Probability that a download is answered
+            with 503 Service Unavailable.
+        abort_rate (float): Probability that the connection of a
+            download is closed after half of the bytes.
+        range_support (bool): Whether Range requests are supported.
+
+    """
+    latency: float = 0
+    bandwidth: float = None
+    failure_rate: float = 0
+    abort_rate: float = 0
+    range_support: bool = True
+
+
+class SyntheticArchive:
+    """Files and search documents of a synthetic CMIP6 archive.
+
+    Args:
+        n_files (int): Number of files (per replica).
+        file_size (int): Size of every file in bytes.
+        variables (list[str]): Variables of the files.
+        n_models (int): Number of models.
+        n_members (int): Number of members per model.
+        seed (int): Seed of the file content.
+
+    """
+    def __init__(self, n_files, file_size, variables=('tas', 'pr'),
+                 n_models=10, n_members=5, seed=0):
+        block = random.Random(seed).randbytes(BLOCK_SIZE)
+        # Doubled so that every chunk of a file is a single slice
+        self._block = memoryview(block + block)
+        self.file_size = file_size
+        self.files = {}
+        for i in range(n_files):
+            variable = variables[i % len(variables)]
+            j = i // len(variables)
+            model = f'MODEL{j % n_models}'
+            member = f'r{j // n_models % n_members + 1}i1p1f1'
+            year = 1850 + j // (n_models*n_members)
+            filename = (
+                f'{variable}_Amon_{model}_historical_{member}_gn_'
+                f'{year}01-{year}12.nc')
+            offset = (i * 4099) % BLOCK_SIZE
+            self.files[filename] = (offset, {
+                'variable': [variable], 'variable_id': [variable],
+                'frequency': ['mon'], 'experiment_id': ['historical'],
+                'source_id': [model], 'member_id': [member],
+                'grid_label': ['gn'], 'table_id': ['Amon'],
+                'activity_id': ['CMIP']})
+        self.checksums = {
+            filename: self._sha256(filename) for filename in self.files}
+
+    def iter_content(self, filename, start=0, end=None):
+        """Yield the bytes start to end (exclusive) of filename."""
+        offset, _ = self.files[filename]
+        end = self.file_size if end is None else end
+        position = start
+        while position < end:
+            n = min(CHUNK_SIZE, end - position)
+            i = (offset + position) % BLOCK_SIZE
+            yield self._block[i:i+n]
+            position += n
+
+    def _sha256(self, filename):
+        checksum_hash = hashlib.sha256()
+        for chunk in self.iter_content(filename):
+            checksum_hash.update(chunk)
+        return checksum_hash.hexdigest()
+
+    def get_docs(self, data_node_urls, query):
+        """Return the search documents of all replicas matching query.
+
+        Args:
+            data_node_urls (list[str]): Base URLs of the data nodes.
+            query (dict): Parsed search parameters (values are lists).
+
+        """
+        facets = {k: set(v) for k, v in query.items() if k in FACETS}
+        docs = []
+        for filename, (_, file_facets) in self.files.items():
+            if any(file_facets[k][0] not in v for k, v in facets.items()):
+                continue
+            for data_node_url in data_node_urls:
+                host = urllib.parse.urlparse(data_node_url).netloc
+                docs.append({
+                    'id': f'{filename}|{host}',
+                    'title': filename,
+                    'checksum': [self.checksums[filename]],
+                    'checksum_type': ['SHA256'],
+                    'size': str(self.file_size),
+                    'data_node': host,
+                    'url': [
+                        f'{data_node_url}{FILE_PATH}{filename}'
+                        '|application/netcdf|HTTPServer',
+                        f'gsiftp://{host}/{filename}'
+                        '|application/gridftp|GridFTP'],
+                    **file_facets,
+                    })
+        return docs
+
+
+class IndexNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != SEARCH_PATH:
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        time.sleep(self.server.latency)
+        docs = self.server.archive.get_docs(self.server.data_node_urls, query)
+        offset = int(query.get('offset', [0])[0])
+        limit = int(query.get('limit', [10])[0])
+        page = docs[offset:offset+limit]
+        if query.get('format') == ['application/solr+json']:
+            content = docs_as_json(page, num_found=len(docs), start=offset)
+            content_type = 'application/json'
+        else:
+            content = docs_as_xml(page, num_found=len(docs), start=offset)
+            content_type = 'text/xml'
+        self.server.n_requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class DataNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _get_filename(self):
+        path = urllib.parse.urlparse(self.path).path
+        filename = path[len(FILE_PATH):]
+        if not path.startswith(FILE_PATH) or \
+                filename not in self.server.archive.files:
+            self.send_error(404)
+            return None
+        return filename
+
+    def _get_range(self):
+        """Return (start, end) of the requested bytes (end exclusive)."""
+        size = self.server.archive.file_size
+        header = self.headers.get('Range')
+        if header is None or not self.server.settings.range_support:
+            return 0, size
+        start, _, end = header.split('=', 1)[1].partition('-')
+        end = size if end == '' else min(int(end) + 1, size)
+        return int(start), end
+
+    def do_HEAD(self):
+        time.sleep(self.server.settings.latency)
+        if self._get_filename() is None:
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(self.server.archive.file_size))
+        if self.server.settings.range_support:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        settings = self.server.settings
+        time.sleep(settings.latency)
+        filename = self._get_filename()
+        if filename is None:
+            return
+        if random.random() < settings.failure_rate:
+            self.server.n_failures += 1
+            self.send_error(503)
+            return
+        size = self.server.archive.file_size
+        start, end = self._get_range()
+        if start >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if (start, end) == (0, size):
+            self.send_response(200)
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end-1}/{size}')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        abort_at = None
+        if random.random() < settings.abort_rate:
+            abort_at = start + (end - start) // 2
+            self.server.n_failures += 1
+        t0 = time.monotonic()
+        n_bytes = 0
+        for chunk in self.server.archive.iter_content(filename, start, end):
+            if abort_at is not None and start + n_bytes >= abort_at:
+                self.close_connection = True
+                return
+            self.wfile.write(chunk)
+            n_bytes += len(chunk)
+            if settings.bandwidth:
+                delay = n_bytes / settings.bandwidth - (time.monotonic() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+        self.server.n_bytes += n_bytes
+
+
+class FakeESGF:
+    """Fake index node and data nodes serving a SyntheticArchive.
+
+    Args:
+        archive (SyntheticArchive): Served files.
+        data_node_settings (list[DataNodeSettings]): Settings of every
+            data node (one replica of every file per data node).
+        search_latency (float): Seconds before every search response.
+
+    Attributes:
+        search_url (str): URL of the search API.
+
+    """
+    def __init__(self, archive, data_node_settings, search_latency=0):
+        self.archive = archive
+        self.data_nodes = []
+        for settings in data_node_settings:
+            server = ThreadingHTTPServer(('127.0.0.1', 0), DataNodeHandler)
+            server.daemon_threads = True
+            server.archive = archive
+            server.settings = settings
+            server.n_bytes = server.n_failures = 0
+            self.data_nodes.append(server)
+        self.index_node = ThreadingHTTPServer(
+            ('127.0.0.1', 0), IndexNodeHandler)
+        self.index_node.daemon_threads = True
+        self.index_node.archive = archive
+        self.index_node.latency = search_latency
+        self.index_node.n_requests = 0
+        self.index_node.data_node_urls = [
+            f'http://127.0.0.1:{s.server_port}' for s in self.data_nodes]
+        self.search_url = (
+            f'http://127.0.0.1:{self.index_node.server_port}{SEARCH_PATH}')
+
+    def start(self):
+        for server in [self.index_node] + self.data_nodes:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in [self.index_node] + self.data_nodes:
+            server.shutdown()
+            server.server_close()
+
+
+def _serve(connection, archive_kwargs, data_node_settings, search_latency):
+    fake_esgf = FakeESGF(
+        SyntheticArchive(**archive_kwargs), data_node_settings,
+        search_latency=search_latency).start()
+    connection.send(fake_esgf.search_url)
+    # Serve until the parent closes the connection (or terminates us)
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    fake_esgf.stop()
+
+
+def start_fake_esgf(archive_kwargs, data_node_settings, search_latency=0):
+    """Run a FakeESGF in a separate process.
+
+    The servers do not compete with the benchmarked code for the GIL.
+
+    Returns:
+        (process, search_url): Terminate the process to stop the
+            servers.
+
+    """
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve, daemon=True, args=(
+            child_connection, archive_kwargs, data_node_settings,
+            search_latency))
+    process.start()
+    return process, parent_connection.recv()
+
+
+def add_arguments(parser):
+    """Add the options of the fake ESGF to an argparse parser."""
+    parser.add_argument('--n-files', type=int, default=200)
+    parser.add_argument(
+        '--file-size', type=float, default=4, help='File size in MB.')
+    parser.add_argument('--n-replicas', type=int, default=2)
+    parser.add_argument(
+        '--search-latency', type=float, default=0,
+        help='Seconds before every search response.')
+    parser.add_argument(
+        '--latency', type=float, nargs='+', default=[0],
+        help='Seconds before every response of the data nodes. Several '
+             'values are assigned to the data nodes in turn.')
+    parser.add_argument(
+        '--bandwidth', type=float, nargs='+', default=[0],
+        help='MB/s per connection of the data nodes (0 for no limit).')
+    parser.add_argument(
+        '--failure-rate', type=float, nargs='+', default=[0],
+        help='Probability of a 503 response of the data nodes.')
+    parser.add_argument(
+        '--abort-rate', type=float, nargs='+', default=[0],
+        help='Probability that the data nodes abort a transfer.')
+    parser.add_argument(
+        '--no-range', action='store_true',
+        help='Data nodes do not support Range requests.')
+
+
+def get_fake_esgf_kwargs(args):
+    """Return the arguments of FakeESGF (or start_fake_esgf) of args."""
+    def value(values, i):
+        return values[i % len(values)]
+
+    data_node_settings = [
+        DataNodeSettings(
+            latency=value(args.latency, i),
+            bandwidth=value(args.bandwidth, i) * 1024**2 or None,
+            failure_rate=value(args.failure_rate, i),
+            abort_rate=value(args.abort_rate, i),
+            range_support=not args.no_range)
+        for i in range(args.n_replicas)]
+    archive_kwargs = {
+        'n_files': args.n_files, 'file_size': int(args.file_size * 1024**2)}
+    return archive_kwargs, data_node_settings, args.search_latency
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+    archive_kwargs, data_node_settings, search_latency = \
+        get_fake_esgf_kwargs(args)
+    fake_esgf = FakeESGF(
+        SyntheticArchive(**archive_kwargs), data_node_settings,
+        search_latency=search_latency).start()
+    print(f'Search API: {fake_esgf.search_url}')
+    for url in fake_esgf.index_node.data_node_urls:
+        print(f'Data node: {url}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake_esgf.stop()
@@ -1,18 +1,27 @@
 import argparse
 import copy
 import itertools
-import multiprocessing
-from multiprocessing import Pool
 from pathlib import Path
 from pprint import pprint
 import sys
+import time
 
+from cmip6download import bandwidth
+from cmip6download.concurrency import AdaptiveConcurrencyController
 from cmip6download import helper
 from cmip6download.config import CMIP6Config
-from cmip6download.data_item import CMIP6DataItem
+from cmip6download.data_item import (
+    CMIP6DataItem, DataItemIndex, DownloadSettings)
+from cmip6download import host_health
+from cmip6download import http_session
+from cmip6download import inventory
+from cmip6download import metrics
 from cmip6download.query import CMIP6APIQuery
+from cmip6download.scheduler import DownloadResult, DownloadScheduler
 from cmip6download.searcher import CMIP6APISearcher
+from cmip6download.search_cache import SearchCache
 from cmip6download import progress_logging
+from cmip6download import tracing
 
 
 parser = argparse.ArgumentParser(description='Download CMIP6.')
@@ -30,10 +39,42 @@ parser.add_argument(
     '--gosearch', action='store_true', default=False)
 parser.add_argument(
     '--debug', action='store_true', default=False)
+parser.add_argument(
+    '--force-rehash', action='store_true', dest='force_rehash',
+    default=False,
+    help='Rehash all files when verifying (ignore the checksum index).')
+parser.add_argument(
+    '--refresh-search', action='store_true', dest='refresh_search',
+    default=False,
+    help='Ignore cached search results.')
+parser.add_argument(
+    '--reconcile-inventory', action='store_true',
+    dest='reconcile_inventory', default=False,
+    help='Scan base_data_dir and update the inventory of local files.')
+parser.add_argument(
+    '--engine', choices=['process', 'async'], default='process',
+    help='Download with a pool of processes (default) or with asyncio '
+         'in a single process (requires aiohttp).')
+parser.add_argument(
+    '--trace', nargs='?', const='cmip6download_trace', default=None,
+    metavar='DIR',
+    help='Record the timings of all phases of every query and file and '
+         'write them as Chrome trace to DIR.')
+parser.add_argument(
+    '--profile', nargs='?', const='cmip6download_profile', default=None,
+    metavar='DIR',
+    help='Profile the main and all worker processes with cProfile and '
+         'write their stats to DIR.')
 args = parser.parse_args()
 VERIFY = args.verify
 GOSEARCH = args.gosearch
 DEBUG = args.debug
+REFRESH_SEARCH = args.refresh_search
+RECONCILE_INVENTORY = args.reconcile_inventory
+FORCE_REHASH = args.force_rehash
+ENGINE = args.engine
+TRACE_DIR = args.trace
+PROFILE_DIR = args.profile
 
 CONFIG_FILE = Path.home() / '.config/cmip6download/config.yaml'
 if args.config_file is not None:
@@ -41,15 +82,40 @@ if args.config_file is not None:
 CONFIG = CMIP6Config.create_from_yaml(CONFIG_FILE)
 QUERY_FILE = Path(args.query_file)
 QUERIES = CMIP6APIQuery.create_from_yaml(QUERY_FILE)
+DOWNLOAD_SETTINGS = DownloadSettings.create_from_config(CONFIG)
+http_session.configure(
+    pool_connections=getattr(CONFIG, 'http_pool_connections', None),
+    pool_maxsize=getattr(CONFIG, 'http_pool_maxsize', None))
+
+
+def init_worker(bandwidth_limits, bytes_counter, trace_run_id):
+    bandwidth.set_limits(*bandwidth_limits)
+    metrics.set_bytes_counter(bytes_counter)
+    # Forked workers must not report the metrics of the main process.
+    metrics.reset_metrics()
+    tracing.configure(TRACE_DIR, trace_run_id)
+    if PROFILE_DIR is not None:
+        tracing.start_profile(PROFILE_DIR, 'worker')
+    # The observations are sent to and saved by the main process
+    host_health.get_host_health_table().start_journal()
+
+
+def download_and_verify(i, data_item, reverify_data, host=None):
+    with tracing.span('job', index=i, filename=data_item.filename):
+        return _download_and_verify(i, data_item, reverify_data, host)
 
 
-def download_and_verify(i, data_item, reverify_data, return_dict):
-    if data_item.verify_download(verify_checksum=reverify_data):
+def _download_and_verify(i, data_item, reverify_data, host=None):
+    if host is not None:
+        data_item.restrict_to_host(host)
+    if data_item.verify_download(
+            verify_checksum=reverify_data, force_rehash=FORCE_REHASH):
         print(f'[{i}] Already exists... {data_item.filename}')
     else:
         print(f'[{i}] Download {data_item.file_url}')
         download_status = data_item.download(
-            max_attempts=CONFIG.max_download_attempts)
+            max_attempts=CONFIG.max_download_attempts,
+            settings=DOWNLOAD_SETTINGS, defer_retries=True)
         if download_status is not None:
             import datetime
             data_item.download_date = datetime.date.today().strftime(
@@ -57,10 +123,26 @@ def download_and_verify(i, data_item, reverify_data, return_dict):
             print(f'[{i}] Success! Downloaded {data_item.filename}!')
         else:
             data_item.download_date = None
-    return_dict[i] = data_item
+    if DEBUG:
+        http_session.log_stats()
+    return DownloadResult(
+        index=i, filename=data_item.filename,
+        verified=data_item.verify_download(),
+        download_date=data_item.download_date,
+        used_download_urls=data_item._used_download_urls,
+        transfers=data_item._transfers,
+        metrics=metrics.get_metrics().snapshot(reset=True),
+        host_health=host_health.get_host_health_table().pop_journal(),
+        retry_after=data_item.retry_after,
+        retry_host=data_item.retry_host,
+        rotation=data_item._rotation)
 
 
 if __name__ == '__main__':
+    tracing.configure(TRACE_DIR)
+    if PROFILE_DIR is not None:
+        tracing.start_profile(PROFILE_DIR, 'main')
+
     reverify_data = False
     if VERIFY is None:
         if helper.ask_user('Reverify all already downloaded files?'):
@@ -76,10 +158,36 @@ if __name__ == '__main__':
             print('Abort.')
             sys.exit()
 
+    search_cache = None
+    if getattr(CONFIG, 'search_cache_dir', None) is not None:
+        search_cache = SearchCache(
+            CONFIG.search_cache_dir,
+            ttl=getattr(CONFIG, 'search_cache_ttl', 24) * 3600,
+            max_size=getattr(CONFIG, 'search_cache_max_size', 512) * 1024**2,
+            refresh=REFRESH_SEARCH)
+
+    host_health.set_host_health_table(host_health.HostHealthTable.load(
+        getattr(CONFIG, 'host_health_file', None) or
+        CONFIG.base_data_dir / '.host_health.json'))
+
+    if getattr(CONFIG, 'use_inventory', True):
+        new_inventory = not (
+            Path(CONFIG.base_data_dir) / inventory.MANIFEST_FILENAME).exists()
+        local_inventory = inventory.Inventory.load(CONFIG.base_data_dir)
+        if new_inventory or RECONCILE_INVENTORY:
+            local_inventory.reconcile()
+        print(f'{len(local_inventory)} files in local inventory.')
+        inventory.set_inventory(local_inventory)
+
     searcher = CMIP6APISearcher(
-        CONFIG.cmip6restapi_url, CONFIG.base_data_dir)
+        CONFIG.cmip6restapi_url, CONFIG.base_data_dir,
+        n_search_workers=getattr(CONFIG, 'n_search_workers', 1),
+        search_page_size=getattr(CONFIG, 'search_page_size', None),
+        max_search_attempts=getattr(CONFIG, 'max_search_attempts', 1),
+        search_response_parser=getattr(
+            CONFIG, 'search_response_parser', 'json'),
+        search_cache=search_cache)
 
-    all_failed_data_items = []
     all_data_items = []
 
     # If in the config the min_number_of_members is set the following
@@ -118,12 +226,6 @@ if __name__ == '__main__':
     else:
         print('min_number_of_members was not set.')
 
-    add_queries2 = []
-    for query in all_queries:
-        query = copy.deepcopy(query)
-        add_queries2.append(query)
-    all_queries.extend(add_queries2)
-
     # If max_number_of_members is set,
     # data_item_filter_kwargs["max_number_of_members"] is set to
     # max_number_of_members.
@@ -135,43 +237,117 @@ if __name__ == '__main__':
 
     print(f'data_item_filter_kwargs: {data_item_filter_kwargs}')
 
-    for query in reversed(sorted(all_queries)):
-        query_data_items = searcher.get_data_items(
-            query, filter_kwargs=data_item_filter_kwargs)
-        N_query_data_items = len(query_data_items)
+    search_results = searcher.get_data_items_concurrently(
+        all_queries, filter_kwargs=data_item_filter_kwargs)
+    http_session.log_stats()
+
+    # Files found by several queries are only downloaded once.
+    data_item_index = DataItemIndex()
+    for query, query_data_items in search_results:
         cmip6_api_search_call = searcher.get_request_url(query)
         for data_item in query_data_items:
             data_item.query_file = QUERY_FILE
             data_item.cmip6_api_search_call = cmip6_api_search_call
+            data_item_index.add(data_item, query)
         print(f'Search for {query.name}: > '
               f'{len(query_data_items)} < files found')
+    n_found = sum(len(items) for _, items in search_results)
+    print(f'{len(data_item_index)} unique files found '
+          f'({n_found - len(data_item_index)} found by several queries).')
+
+    all_hosts = {
+        host_health.get_host(url)
+        for data_item in data_item_index
+        for url in data_item.file_urls}
+    bandwidth_limits = bandwidth.create_limits(
+        all_hosts,
+        max_bandwidth=getattr(CONFIG, 'max_bandwidth', None),
+        max_host_bandwidth=getattr(CONFIG, 'max_host_bandwidth', None))
+    bytes_counter = metrics.SharedCounter()
+    if ENGINE == 'async':
+        from cmip6download.async_engine import AsyncDownloadEngine
+        bandwidth.set_limits(*bandwidth_limits)
+        metrics.set_bytes_counter(bytes_counter)
+        scheduler = AsyncDownloadEngine(
+            getattr(CONFIG, 'n_async_downloads', 100),
+            max_attempts=CONFIG.max_download_attempts,
+            force_rehash=FORCE_REHASH,
+            max_downloads_per_host=getattr(
+                CONFIG, 'max_downloads_per_host', None),
+            settings=DOWNLOAD_SETTINGS)
+    else:
+        controller = None
+        if getattr(CONFIG, 'adaptive_concurrency', False):
+            controller = AdaptiveConcurrencyController(
+                CONFIG.n_worker,
+                initial_limit=getattr(CONFIG, 'initial_n_worker', 2),
+                max_host_limit=getattr(
+                    CONFIG, 'max_downloads_per_host', None))
+        scheduler = DownloadScheduler(
+            CONFIG.n_worker, download_and_verify,
+            max_downloads_per_host=getattr(
+                CONFIG, 'max_downloads_per_host', None),
+            controller=controller,
+            initializer=init_worker,
+            initargs=(
+                bandwidth_limits, bytes_counter, tracing.get_run_id()))
+    for data_item in data_item_index:
+        scheduler.add(
+            data_item_index.get_priority(data_item), len(all_data_items),
+            data_item, reverify_data, hosts=[
+                host_health.get_host(url) for url in data_item.file_urls])
+        all_data_items.append(data_item)
+
+    # Every finished item is recorded at once, so that the progress is
+    # kept even if the run is interrupted.
+    progress_store = progress_logging.get_progress_store(CONFIG)
+    verified = [False] * len(all_data_items)
+    n_done = n_failed = 0
+    remaining_bytes = sum(di.size or 0 for di in all_data_items)
+
+    def get_status():
+        return {
+            'files_found': len(all_data_items), 'files_done': n_done,
+            'files_failed': n_failed, 'queue_depth': len(scheduler),
+            'running': scheduler.n_running,
+            'remaining_bytes': remaining_bytes}
+    reporter = metrics.MetricsReporter(
+        getattr(CONFIG, 'metrics_interval', 30),
+        path=getattr(CONFIG, 'metrics_file', None),
+        status_func=get_status, bytes_counter=bytes_counter).start()
+    for result in scheduler.run():
+        data_item = all_data_items[result.index]
+        data_item._used_download_urls = result.used_download_urls
+        if result.metrics:
+            metrics.get_metrics().merge(result.metrics)
+        if result.host_health:
+            host_health.get_host_health_table().apply_journal(
+                result.host_health)
+        host_health.get_host_health_table().save_periodically()
+        if result.retry_after is not None:
+            # Wait for the next attempt without occupying a worker
+            data_item._rotation = result.rotation
+            scheduler.add(
+                data_item_index.get_priority(data_item), result.index,
+                data_item, reverify_data, hosts=[result.retry_host],
+                not_before=time.monotonic() + result.retry_after)
+            continue
+        data_item.download_date = result.download_date
+        verified[result.index] = result.verified
+        progress_store.record(data_item, verified=result.verified)
+        metrics.get_metrics().inc(
+            'finished_files_total',
+            status='verified' if result.verified else 'failed')
+        n_done += 1
+        n_failed += not result.verified
+        remaining_bytes -= data_item.size or 0
+        if not result.verified:
+            print('[FAILED] ', data_item.filename,
+                  data_item._used_download_urls)
 
-        with Pool(CONFIG.n_worker) as p:
-            manager = multiprocessing.Manager()
-            return_dict = manager.dict()
-            data = list(zip(
-                list(range(N_query_data_items)), query_data_items,
-                [reverify_data]*N_query_data_items,
-                [return_dict]*N_query_data_items))
-            p.starmap(download_and_verify, data, chunksize=1)
-            data_items = return_dict.values()
-
-        failed_data_items = []
-        for data_item in data_items:
-            if not data_item.verify_download():
-                failed_data_items.append(data_item)
-
-        if len(failed_data_items) > 0:
-            print('----------------------------------------------')
-            print('The following files could not be downloaded:')
-            for data_item in failed_data_items:
-                    print(
-                        '[FAILED] ', data_item.filename,
-                        data_item._used_download_urls)
-            print('----------------------------------------------')
-
-        all_failed_data_items.extend(failed_data_items)
-        all_data_items.extend(data_items)
+    all_failed_data_items = [
+        data_item for data_item, v in zip(all_data_items, verified)
+        if not v]
 
     print(f'A total of {len(all_failed_data_items)} downloads failed.')
     if len(all_failed_data_items):
@@ -179,4 +355,9 @@ if __name__ == '__main__':
         for data_item in all_failed_data_items:
             print(f'> {data_item.filename}')
 
-    progress_logging.log_download_progress(CONFIG, all_data_items)
+    reporter.stop()
+    host_health.get_host_health_table().save()
+    progress_store.export_csv_files()
+    tracing.dump_profile()
+    if TRACE_DIR is not None:
+        tracing.merge_traces(TRACE_DIR)
@@ -0,0 +1,344 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import functools
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from cmip6download import bandwidth
+from cmip6download import file_writer
+from cmip6download import helper
+from cmip6download import host_health
+from cmip6download import metrics
+from cmip6download import retry
+from cmip6download import tracing
+from cmip6download.data_item import (
+    DownloadSettings, HTTP_DOWNLOAD_TIMEOUT_TIME)
+from cmip6download.scheduler import DownloadResult
+
+
+logger = helper.get_logger(__file__)
+
+
+_DONE = object()
+# Buffer per download (the buffer of DownloadSettings is meant for a
+# few parallel downloads, not for hundreds)
+ASYNC_BUFFER_SIZE = 1024**2
+
+
+class AsyncDownloadEngine:
+    """Download engine running all transfers in a single process.
+
+    This is an alternative to DownloadScheduler: instead of a process
+    per parallel download, n_concurrent coroutines share one event
+    loop (in a background thread) and one aiohttp session. Chunks are
+    buffered, hashed and written to disk (see file_writer.FileWriter)
+    by a small thread pool, so the event loop never waits for the disk
+    and the number of threads does not grow with the number of
+    parallel downloads.
+
+    The semantics follow BaseDataItem.download: data is streamed into
+    the part file (resuming it with a Range request if possible),
+    verified against the remote checksum and moved into place; failed
+    attempts are retried on the next replica, up to max_attempts times
+    in total (see retry.ReplicaRotation). Segmented downloads are not
+    used by this engine.
+
+    Requires the optional dependency aiohttp.
+
+    Args:
+        n_concurrent (int): Number of parallel downloads.
+        max_attempts (int): Number of attempts per file (over all
+            replicas).
+        force_rehash (bool): Passed to verify_download.
+        max_downloads_per_host (int): Maximum number of connections
+            per host (None for no limit).
+        n_writer_threads (int): Number of threads writing to disk.
+        n_verify_threads (int): Number of threads verifying (hashing)
+            files, so that hashing complete files does not hold up the
+            writes of running downloads.
+        settings (DownloadSettings): Retry backoff and write settings
+            (the buffer is limited to ASYNC_BUFFER_SIZE per download).
+
+    """
+    def __init__(
+            self, n_concurrent, max_attempts=1, force_rehash=False,
+            max_downloads_per_host=None, n_writer_threads=8,
+            n_verify_threads=4, settings=None):
+        if aiohttp is None:
+            raise ImportError(
+                'The async engine requires aiohttp '
+                '(pip install cmip6download[async]).')
+        self.n_concurrent = max(1, n_concurrent)
+        self.max_attempts = max(1, max_attempts)
+        self.force_rehash = force_rehash
+        self.max_downloads_per_host = max_downloads_per_host
+        self.n_writer_threads = n_writer_threads
+        self.n_verify_threads = n_verify_threads
+        self.settings = settings or DownloadSettings()
+        self._jobs = []
+        self._counter = itertools.count()
+        self.n_running = 0
+        self._n_queued = 0
+
+    def __len__(self):
+        return len(self._jobs) + self._n_queued
+
+    def add(self, priority, i, data_item, reverify_data, hosts=None):
+        """Add a data item with the given priority.
+
+        hosts is accepted for compatibility with DownloadScheduler; the
+        per-host limit is enforced by the connection pool instead.
+
+        """
+        heapq.heappush(self._jobs, (
+            -priority, next(self._counter), (i, data_item, reverify_data)))
+
+    def run(self):
+        """Run all downloads and yield DownloadResults as they finish."""
+        jobs = [heapq.heappop(self._jobs)[2] for _ in range(len(self._jobs))]
+        self._n_queued = len(jobs)
+        results = queue.Queue()
+        thread = threading.Thread(
+            target=asyncio.run, args=(self._run(jobs, results.put),),
+            daemon=True)
+        thread.start()
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            if isinstance(result, BaseException):
+                logger.error(f'Download job failed: {result!r}')
+                continue
+            yield result
+        thread.join()
+
+    async def _run(self, jobs, put):
+        jobs = iter(jobs)
+        connector = aiohttp.TCPConnector(
+            limit=self.n_concurrent,
+            limit_per_host=self.max_downloads_per_host or 0, ssl=False)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=host_health.HTTP_PROBE_TIMEOUT_TIME[0],
+            sock_read=HTTP_DOWNLOAD_TIMEOUT_TIME)
+
+        async def worker(session, writer, verifier):
+            # All workers share the job iterator, so every worker
+            # always takes the job with the highest remaining priority.
+            for args in jobs:
+                self._n_queued -= 1
+                self.n_running += 1
+                try:
+                    put(await self._download_and_verify(
+                        session, writer, verifier, *args))
+                except Exception as e:
+                    put(e)
+                finally:
+                    self.n_running -= 1
+
+        try:
+            with ThreadPoolExecutor(self.n_writer_threads) as writer, \
+                    ThreadPoolExecutor(self.n_verify_threads) as verifier:
+                async with aiohttp.ClientSession(
+                        connector=connector, timeout=timeout) as session:
+                    await asyncio.gather(*(
+                        worker(session, writer, verifier)
+                        for _ in range(self.n_concurrent)))
+        finally:
+            put(_DONE)
+
+    async def _download_and_verify(
+            self, session, writer, verifier, i, data_item, reverify_data):
+        loop = asyncio.get_running_loop()
+        verified = await loop.run_in_executor(verifier, functools.partial(
+            data_item.verify_download, verify_checksum=reverify_data,
+            force_rehash=self.force_rehash))
+        if verified:
+            print(f'[{i}] Already exists... {data_item.filename}')
+        else:
+            print(f'[{i}] Download {data_item.filename}')
+            download_status = await self._download(
+                session, writer, verifier, data_item)
+            if download_status is not None:
+                data_item.download_date = datetime.date.today().strftime(
+                    '%Y-%m-%d')
+                print(f'[{i}] Success! Downloaded {data_item.filename}!')
+            else:
+                data_item.download_date = None
+        verified = await loop.run_in_executor(
+            verifier, data_item.verify_download)
+        return DownloadResult(
+            index=i, filename=data_item.filename, verified=verified,
+            download_date=data_item.download_date,
+            used_download_urls=data_item._used_download_urls,
+            transfers=data_item._transfers)
+
+    async def _probe(self, session, data_item):
+        """Async version of host_health.probe_urls."""
+        table = host_health.get_host_health_table()
+        candidates = host_health.get_probe_candidates(
+            data_item.file_urls, table)
+        if not candidates:
+            return []
+        probe_timeout = aiohttp.ClientTimeout(
+            sock_connect=host_health.HTTP_PROBE_TIMEOUT_TIME[0],
+            total=sum(host_health.HTTP_PROBE_TIMEOUT_TIME))
+
+        async def probe(url):
+            t0 = time.monotonic()
+            try:
+                async with session.head(
+                        url, allow_redirects=True,
+                        timeout=probe_timeout) as r:
+                    status = r.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None, None
+            return time.monotonic() - t0, status
+
+        tasks = {asyncio.ensure_future(probe(u)): u for u in candidates}
+        results = host_health.ProbeResults(table)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=results.get_timeout(),
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                results.add(tasks[task], *task.result())
+        for task in pending:
+            task.cancel()
+        return results.rank()
+
+    async def _download(self, session, writer, verifier, data_item):
+        """Download data_item, return its local file or None."""
+        loop = asyncio.get_running_loop()
+        table = host_health.get_host_health_table()
+        if data_item._used_download_urls is None:
+            data_item._used_download_urls = []
+
+        def prepare():
+            data_item.remove_local_file()
+            data_item.local_dir.mkdir(exist_ok=True, parents=True)
+        await loop.run_in_executor(writer, prepare)
+
+        urls = await self._probe(session, data_item)
+        rotation = retry.ReplicaRotation(
+            urls + [u for u in data_item.file_urls if u not in urls],
+            self.settings.get_retry_policy(self.max_attempts))
+        for url, delay in iter(rotation.next, None):
+            if rotation.n_attempts > 1:
+                logger.warning(
+                    f'Download or verification failed. Retry with {url} '
+                    f'in {delay:.1f}s (attempt {rotation.n_attempts} of '
+                    f'{rotation.policy.max_attempts}).')
+                await asyncio.sleep(delay)
+            data_item._used_download_urls.append(url)
+            host = host_health.get_host(url)
+            t0 = time.monotonic()
+            with tracing.span(
+                    'transfer', filename=data_item.filename, url=url,
+                    attempt=rotation.n_attempts):
+                n_bytes, complete, checksum, error = \
+                    await self._http_get(
+                        session, writer, verifier, data_item, url)
+            duration = time.monotonic() - t0
+            if error in host_health.HOST_ERRORS:
+                table.record_failure(host)
+            elif error is None and not complete:
+                error = 'incomplete'
+            elif error is None and not await loop.run_in_executor(
+                    verifier, data_item._finalize_part_file, checksum):
+                error = 'checksum'
+            data_item._transfers.append((host, n_bytes, duration, error))
+            metrics.record_transfer(host, n_bytes, duration, error)
+            if error is None:
+                logger.info(f'Download of {data_item.filename} successfull.')
+                table.record_transfer(host, n_bytes, duration)
+                return data_item.local_file
+            rotation.record_failure(url, error)
+        logger.warning(f'Failed. Exceeded max number of attempts.')
+        return None
+
+    async def _http_get(self, session, writer, verifier, data_item, url):
+        """Stream url into the part file of data_item.
+
+        Returns:
+            (n_bytes, complete, checksum, error): As returned by
+                BaseDataItem._http_get plus the error category (see
+                data_item.classify_error) if the transfer failed.
+
+        """
+        loop = asyncio.get_running_loop()
+        host = host_health.get_host(url)
+        part_file = data_item.local_part_file
+        offset = await loop.run_in_executor(
+            writer, file_writer.get_valid_length, part_file)
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+        n_bytes = 0
+        try:
+            async with session.get(
+                    url, headers=headers, allow_redirects=True) as r:
+                if r.status == 416:
+                    # The part file already has the full size
+                    checksum = await loop.run_in_executor(
+                        verifier, data_item._checksum, part_file)
+                    if checksum == data_item.remote_checksum:
+                        return n_bytes, True, checksum, None
+                    logger.info(
+                        f'Discard part file of {data_item.filename}.')
+                    await loop.run_in_executor(
+                        writer, data_item._remove_part_file)
+                    return await self._http_get(
+                        session, writer, verifier, data_item, url)
+                r.raise_for_status()
+                mode = 'wb'
+                checksum_hash = data_item._new_checksum_hash()
+                if offset > 0 and r.status == 206:
+                    logger.info(
+                        f'Resume download of {data_item.filename} at '
+                        f'byte {offset}.')
+                    mode = 'ab'
+                    checksum_hash = None
+                size = None
+                if self.settings.preallocate and \
+                        r.content_length is not None:
+                    size = r.content_length + (offset if mode == 'ab' else 0)
+                f = await loop.run_in_executor(writer, functools.partial(
+                    file_writer.FileWriter, part_file, mode, size=size,
+                    buffer_size=min(
+                        self.settings.buffer_size, ASYNC_BUFFER_SIZE),
+                    checksum_hash=checksum_hash, fsync=self.settings.fsync))
+                complete = False
+                try:
+                    async for chunk in r.content.iter_chunked(
+                            self.settings.chunk_size):
+                        await loop.run_in_executor(writer, f.write, chunk)
+                        n_bytes += len(chunk)
+                        metrics.add_received_bytes(len(chunk))
+                        delay = bandwidth.get_throttle_delay(host, len(chunk))
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    complete = True
+                finally:
+                    await loop.run_in_executor(writer, f.close, complete)
+        except asyncio.TimeoutError as e:
+            logger.error(f'Timeout while downloading {url} ({e!r}).')
+            return n_bytes, False, None, 'timeout'
+        except aiohttp.ClientResponseError as e:
+            logger.error(e)
+            return n_bytes, False, None, retry.classify_status_code(e.status)
+        except aiohttp.ClientError as e:
+            logger.warning(f'Could not finish download of {url} ({e!r})')
+            return n_bytes, False, None, 'connection'
+        if checksum_hash is None:
+            return n_bytes, True, None, None
+        return n_bytes, True, checksum_hash.hexdigest(), None
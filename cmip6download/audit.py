@@ -0,0 +1,163 @@
+"""Check the integrity of all files in base_data_dir.
+
+Usage:
+    python -m cmip6download.audit [--config_file FILE] [--n_processes N]
+        [--block_size MB]
+
+All .nc files below base_data_dir are hashed in a process pool and
+compared against the remote checksums stored in the checksum index.
+
+"""
+import argparse
+import hashlib
+from multiprocessing import Pool
+import os
+from pathlib import Path
+import time
+
+from cmip6download import checksum_index
+from cmip6download import helper
+from cmip6download.config import CMIP6Config
+
+
+HASH_FUNCTIONS = {'SHA256': hashlib.sha256}
+DEFAULT_BLOCK_SIZE = 8
+
+
+def get_hash_function(algorithm):
+    """Return a function creating hashlib objects for algorithm.
+
+    Algorithms other than those in HASH_FUNCTIONS are looked up by
+    their lower case name in hashlib (e.g. MD5 as md5). Returns None
+    if the algorithm is not supported.
+
+    """
+    if algorithm in HASH_FUNCTIONS:
+        return HASH_FUNCTIONS[algorithm]
+    try:
+        hashlib.new(algorithm.lower())
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return lambda: hashlib.new(algorithm.lower())
+
+
+def hash_file(args):
+    """Return (path, size, checksum, error) of a single file.
+
+    The file is read unbuffered with readinto into a single reused
+    buffer of block_size bytes.
+
+    """
+    path, size, algorithm, block_size = args
+    checksum_hash = get_hash_function(algorithm)()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                checksum_hash.update(view[:n])
+    except OSError as e:
+        return path, size, None, str(e)
+    return path, size, checksum_hash.hexdigest(), None
+
+
+def audit(base_data_dir, n_processes=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Hash all .nc files of base_data_dir and compare remote checksums.
+
+    Args:
+        base_data_dir (str or pathlib.Path): Directory to audit.
+        n_processes (int): Size of the process pool (default: number
+            of CPUs).
+        block_size (float): Size of the read buffer in MB.
+
+    Returns:
+        results (dict): Lists of paths which are 'ok', have a
+            'mismatch', have an 'unknown' remote checksum, a checksum
+            type which is not supported ('unsupported') or could not be
+            read ('error').
+
+    """
+    index = checksum_index.get_checksum_index(base_data_dir)
+    remote_checksums = index.get_remote_checksums()
+    block_size = int(block_size * 1024**2)
+
+    results = {
+        'ok': [], 'mismatch': [], 'unknown': [], 'unsupported': [],
+        'error': []}
+    tasks = []
+    for path, stat in helper.scandir_nc_files(base_data_dir):
+        algorithm, _ = remote_checksums.get(
+            os.path.basename(path), ('SHA256', None))
+        if get_hash_function(algorithm) is None:
+            results['unsupported'].append(path)
+            print(f'[UNSUPPORTED] {path}: checksum type {algorithm}')
+            continue
+        tasks.append((path, stat.st_size, algorithm, block_size))
+    # Large files first, so that no single large file is left at the end
+    tasks.sort(key=lambda t: t[1], reverse=True)
+    total_size = sum(t[1] for t in tasks)
+    print(f'Audit {len(tasks)} files ({total_size/1e9:.1f} GB).')
+
+    t0 = time.monotonic()
+    done_size = 0
+    with Pool(n_processes) as p:
+        for i, (path, size, checksum, error) in enumerate(
+                p.imap_unordered(hash_file, tasks, chunksize=1)):
+            done_size += size
+            filename = os.path.basename(path)
+            if error is not None:
+                results['error'].append(path)
+                print(f'[ERROR] {path}: {error}')
+                continue
+            algorithm, remote_checksum = remote_checksums.get(
+                filename, ('SHA256', None))
+            index.set(Path(path), algorithm, checksum)
+            if remote_checksum is None:
+                results['unknown'].append(path)
+            elif checksum == remote_checksum:
+                results['ok'].append(path)
+            else:
+                results['mismatch'].append(path)
+                print(f'[MISMATCH] {path}')
+            if (i + 1) % 100 == 0:
+                elapsed = time.monotonic() - t0
+                print(f'[{i+1}/{len(tasks)}] '
+                      f'{done_size/1e9/elapsed:.2f} GB/s')
+
+    elapsed = time.monotonic() - t0
+    print(
+        f'Audited {len(tasks)} files ({done_size/1e9:.1f} GB) in '
+        f'{elapsed:.1f} s ({done_size/1e9/max(elapsed, 1e-9):.2f} GB/s).')
+    for key, paths in results.items():
+        print(f'{key}: {len(paths)}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check integrity of downloaded CMIP6 data.')
+    parser.add_argument(
+        '--config_file', dest='config_file', default=None,
+        help='YAML configuration file.')
+    parser.add_argument(
+        '--n_processes', dest='n_processes', type=int, default=None,
+        help='Number of hashing processes (default: number of CPUs).')
+    parser.add_argument(
+        '--block_size', dest='block_size', type=float, default=None,
+        help=f'Read block size in MB (default: {DEFAULT_BLOCK_SIZE}).')
+    args = parser.parse_args()
+
+    config_file = Path.home() / '.config/cmip6download/config.yaml'
+    if args.config_file is not None:
+        config_file = Path(args.config_file)
+    config = CMIP6Config.create_from_yaml(config_file)
+
+    n_processes = args.n_processes or getattr(
+        config, 'audit_n_processes', None)
+    block_size = args.block_size or getattr(
+        config, 'audit_block_size', DEFAULT_BLOCK_SIZE)
+    audit(
+        config.base_data_dir, n_processes=n_processes, block_size=block_size)
@@ -0,0 +1,93 @@
+import multiprocessing
+import time
+
+
+class TokenBucket:
+    """Token bucket limiting a transfer rate across processes.
+
+    The state lives in shared memory, so a bucket created before the
+    worker processes are started limits the summed rate of all of
+    them. Consumers may take more tokens than available and then sleep
+    until the debt is paid off, which keeps the average rate at rate
+    while allowing bursts of up to capacity bytes.
+
+    Args:
+        rate (float): Allowed rate in bytes per second.
+        capacity (float): Maximum burst size in bytes (default: one
+            second worth of tokens).
+
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self._lock = multiprocessing.Lock()
+        self._tokens = multiprocessing.RawValue('d', self.capacity)
+        self._last = multiprocessing.RawValue('d', time.monotonic())
+
+    def reserve(self, n_bytes):
+        """Take n_bytes tokens and return the time (s) to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens.value = min(
+                self.capacity,
+                self._tokens.value + (now - self._last.value) * self.rate)
+            self._last.value = now
+            self._tokens.value -= n_bytes
+            debt = -self._tokens.value
+        return max(0, debt / self.rate)
+
+    def consume(self, n_bytes):
+        """Take n_bytes tokens and sleep if the bucket is in debt."""
+        delay = self.reserve(n_bytes)
+        if delay > 0:
+            time.sleep(delay)
+
+
+_global_bucket = None
+_host_buckets = {}
+
+
+def set_limits(global_bucket=None, host_buckets=None):
+    """Set the buckets used by throttle (e.g. in a pool initializer)."""
+    global _global_bucket, _host_buckets
+    _global_bucket = global_bucket
+    _host_buckets = host_buckets or {}
+
+
+def create_limits(hosts, max_bandwidth=None, max_host_bandwidth=None):
+    """Return (global bucket, host buckets) for the given limits in MB/s.
+
+    Must be called before the worker processes are started.
+
+    """
+    global_bucket = None
+    if max_bandwidth:
+        global_bucket = TokenBucket(max_bandwidth * 1024**2)
+    host_buckets = {}
+    if max_host_bandwidth:
+        host_buckets = {
+            host: TokenBucket(max_host_bandwidth * 1024**2)
+            for host in hosts}
+    return global_bucket, host_buckets
+
+
+def get_throttle_delay(host, n_bytes):
+    """Account n_bytes from host against all limits, return delay (s).
+
+    Used by callers which cannot block (e.g. the asyncio engine).
+
+    """
+    delay = 0
+    if _global_bucket is not None:
+        delay = _global_bucket.reserve(n_bytes)
+    bucket = _host_buckets.get(host)
+    if bucket is not None:
+        delay = max(delay, bucket.reserve(n_bytes))
+    return delay
+
+
+def throttle(host, n_bytes):
+    """Account n_bytes transferred from host against all limits."""
+    delay = get_throttle_delay(host, n_bytes)
+    if delay > 0:
+        time.sleep(delay)
@@ -0,0 +1,129 @@
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+INDEX_FILENAME = '.checksum_index.sqlite'
+SQLITE_TIMEOUT_TIME = 60
+
+
+class ChecksumIndex:
+    """Persistent index of verified checksums of local files.
+
+    The index is a sqlite database in base_data_dir. Every entry is
+    keyed by the path of a file and stores the size, mtime and inode
+    the file had when its checksum was computed. As long as these do
+    not change, the stored checksum is returned instead of hashing the
+    file again. Additionally, the remote checksum of every verified
+    file is stored by filename (used by the archive audit).
+
+    The database connection is opened lazily per thread (and again
+    after a fork) so that the index can be used by worker processes
+    and threads.
+
+    Args:
+        base_data_dir (str or pathlib.Path): Directory of the database.
+
+    """
+    def __init__(self, base_data_dir):
+        self.path = Path(base_data_dir) / INDEX_FILENAME
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            local.connection = sqlite3.connect(
+                self.path, timeout=SQLITE_TIMEOUT_TIME)
+            local.pid = os.getpid()
+            with local.connection:
+                local.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS checksums ('
+                    'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                    'inode INTEGER, algorithm TEXT, checksum TEXT, '
+                    'verified REAL)')
+                local.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS remote_checksums ('
+                    'filename TEXT PRIMARY KEY, algorithm TEXT, '
+                    'checksum TEXT)')
+        return local.connection
+
+    def get(self, path, algorithm):
+        """Return stored checksum of path or None if path changed."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        row = self.connection.execute(
+            'SELECT checksum FROM checksums WHERE path = ? AND size = ? '
+            'AND mtime_ns = ? AND inode = ? AND algorithm = ?',
+            (str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino,
+             algorithm)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set(self, path, algorithm, checksum):
+        """Store checksum of path together with its current stat."""
+        stat = os.stat(path)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO checksums (path, size, mtime_ns, '
+                'inode, algorithm, checksum, verified) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                 algorithm, checksum, time.time()))
+
+    def set_remote(self, filename, algorithm, checksum):
+        """Store the remote checksum of filename."""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO remote_checksums '
+                '(filename, algorithm, checksum) VALUES (?, ?, ?)',
+                (filename, algorithm, checksum))
+
+    def get_remote_checksums(self):
+        """Return dict filename -> (algorithm, remote checksum)."""
+        return {
+            filename: (algorithm, checksum)
+            for filename, algorithm, checksum in self.connection.execute(
+                'SELECT filename, algorithm, checksum FROM remote_checksums')
+            }
+
+    def checksum(self, path, algorithm, checksum_func, force_rehash=False):
+        """Return checksum of path, only hashing new or modified files.
+
+        Args:
+            path (pathlib.Path): File to hash.
+            algorithm (str): Name of the checksum type (e.g. SHA256).
+            checksum_func (callable): Computes the checksum of path.
+            force_rehash (bool): If True, the file is always hashed.
+
+        """
+        if not force_rehash:
+            checksum = self.get(path, algorithm)
+            if checksum is not None:
+                logger.debug(f'Use indexed checksum of {path}.')
+                return checksum
+        checksum = checksum_func(path)
+        self.set(path, algorithm, checksum)
+        return checksum
+
+
+_CHECKSUM_INDICES = {}
+
+
+def get_checksum_index(base_data_dir):
+    """Return the (per process cached) ChecksumIndex of base_data_dir."""
+    key = str(base_data_dir)
+    if key not in _CHECKSUM_INDICES:
+        _CHECKSUM_INDICES[key] = ChecksumIndex(base_data_dir)
+    return _CHECKSUM_INDICES[key]
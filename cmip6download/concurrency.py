@@ -0,0 +1,106 @@
+import time
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+# Errors which indicate that a data node (or the network) is overloaded.
+BACKOFF_ERRORS = ('timeout', 'connection', 'server_error', 'rate_limited')
+
+
+class AdaptiveConcurrencyController:
+    """AIMD controller of the number of parallel downloads.
+
+    Globally, the throughput of all downloads is measured over windows
+    of at least interval seconds. As long as the throughput keeps
+    rising, the limit is increased by one per window (additive
+    increase). If any download in a window failed with a timeout, a
+    connection error or a 5xx response, the limit is halved
+    (multiplicative decrease). Windows without any finished transfer
+    (e.g. while only large files are downloaded) are skipped, since
+    their throughput is unknown rather than zero.
+
+    Per host, every such error halves the limit of that host while
+    every successful transfer increases it by 1/limit (i.e. by about
+    one per limit successful downloads).
+
+    Args:
+        max_limit (int): Upper bound of the global limit (n_worker).
+        initial_limit (int): Global limit at the start.
+        max_host_limit (int): Upper bound of the per-host limits.
+        interval (float): Minimum length (s) of a measurement window.
+        tolerance (float): Relative throughput change which is
+            regarded as rising (or falling).
+
+    """
+    def __init__(
+            self, max_limit, initial_limit=2, max_host_limit=None,
+            interval=10, tolerance=0.05):
+        self.max_limit = max(1, max_limit)
+        self.limit = max(1, min(initial_limit, self.max_limit))
+        self.max_host_limit = max_host_limit or self.max_limit
+        self.interval = interval
+        self.tolerance = tolerance
+        self.host_limits = {}
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_transfers = 0
+        self._window_errors = 0
+        self._last_throughput = None
+
+    def get_host_limit(self, host):
+        return int(self.host_limits.get(host, self.max_host_limit))
+
+    def record(self, result):
+        """Update the limits with the transfers of a DownloadResult."""
+        for host, n_bytes, duration, error in result.transfers or []:
+            self._window_bytes += n_bytes
+            self._window_transfers += 1
+            host_limit = self.host_limits.get(host, self.max_host_limit)
+            if error in BACKOFF_ERRORS:
+                self._window_errors += 1
+                new_host_limit = max(1, host_limit / 2)
+                if int(new_host_limit) != int(host_limit):
+                    logger.info(
+                        f'Concurrency of {host}: {int(host_limit)} -> '
+                        f'{int(new_host_limit)} ({error}).')
+            else:
+                new_host_limit = min(
+                    self.max_host_limit, host_limit + 1 / host_limit)
+            self.host_limits[host] = new_host_limit
+        self._update_global_limit()
+
+    def _update_global_limit(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+        if not self._window_transfers:
+            self._window_start = now
+            return
+        throughput = self._window_bytes / elapsed
+        old_limit = self.limit
+        if self._window_errors:
+            self.limit = max(1, self.limit // 2)
+            reason = f'{self._window_errors} errors'
+        elif self._last_throughput is None or \
+                throughput > self._last_throughput * (1 + self.tolerance):
+            self.limit = min(self.max_limit, self.limit + 1)
+            reason = 'throughput rising'
+        elif throughput < self._last_throughput * (1 - self.tolerance):
+            self.limit = max(1, self.limit - 1)
+            reason = 'throughput falling'
+        else:
+            reason = 'throughput stable'
+        # Unchanged limits (e.g. stable throughput) only at debug level
+        log = logger.info if self.limit != old_limit else logger.debug
+        log(
+            f'Concurrency {old_limit} -> {self.limit} ({reason}; '
+            f'{throughput/1024**2:.2f} MB/s).')
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_transfers = 0
+        self._window_errors = 0
@@ -1,17 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
+import hashlib
+import json
+import os
 from pathlib import Path
 from dataclasses import field, dataclass
+import socket
+import threading
+import time
 import requests
+import urllib3
 
+from cmip6download import bandwidth
+from cmip6download import checksum_index
+from cmip6download import file_writer
 from cmip6download import helper
+from cmip6download import host_health
+from cmip6download import http_session
+from cmip6download import inventory
+from cmip6download import metrics
+from cmip6download import retry
+from cmip6download import tracing
 
 
 logger = helper.get_logger(__file__)
 
 
-HTTP_HEAD_TIMEOUT_TIME = 120
 HTTP_DOWNLOAD_TIMEOUT_TIME = 1200
-REQUESTS_CHUNK_SIZE = 128 * 1024
+PART_FILE_SUFFIX = '.part'
+# Suffix of the file listing the finished segments of a part file
+SEGMENTS_FILE_SUFFIX = '.segments'
+
+
+def classify_error(e):
+    """Return the category of an exception raised by a download."""
+    if isinstance(e, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return 'connection'
+    if isinstance(e, requests.HTTPError):
+        if e.response is not None:
+            return retry.classify_status_code(e.response.status_code)
+        return 'http_error'
+    return 'other'
+
+
+@dataclass
+class DownloadSettings:
+    """Tunable parameters of BaseDataItem.download.
+
+    Attributes:
+        segmented_download_threshold (int): Files of at least this size
+            (in bytes) are downloaded in segments over several
+            connections. If None, every file is downloaded in a single
+            stream.
+        n_download_segments (int): Number of segments (and parallel
+            connections) of a segmented download.
+        backoff_base (float): Delay (s) before a replica is retried
+            for the first time (see retry.RetryPolicy).
+        backoff_max (float): Maximum delay (s) before a retry.
+        chunk_size (int): Bytes read from the network at once.
+        buffer_size (int): Bytes collected before they are written to
+            disk (see file_writer.FileWriter).
+        preallocate (bool): Reserve the space of a file before it is
+            downloaded (if its size is known). Off by default: on
+            filesystems without posix_fallocate support in the kernel,
+            the C library emulates it by writing every block.
+        fsync (bool): Flush every downloaded file to disk before it is
+            moved into place.
+
+    """
+    segmented_download_threshold: int = None
+    n_download_segments: int = 4
+    backoff_base: float = 1
+    backoff_max: float = 60
+    chunk_size: int = file_writer.DEFAULT_CHUNK_SIZE
+    buffer_size: int = file_writer.DEFAULT_BUFFER_SIZE
+    preallocate: bool = False
+    fsync: bool = True
+
+    @classmethod
+    def create_from_config(cls, config):
+        threshold = getattr(config, 'segmented_download_threshold', None)
+        return cls(
+            segmented_download_threshold=(
+                None if threshold is None else int(threshold * 1024**2)),
+            n_download_segments=getattr(config, 'n_download_segments', 4),
+            backoff_base=getattr(config, 'download_backoff_base', 1),
+            backoff_max=getattr(config, 'download_backoff_max', 60),
+            chunk_size=int(getattr(
+                config, 'download_chunk_size',
+                file_writer.DEFAULT_CHUNK_SIZE / 1024) * 1024),
+            buffer_size=int(getattr(
+                config, 'download_buffer_size',
+                file_writer.DEFAULT_BUFFER_SIZE / 1024**2) * 1024**2),
+            preallocate=getattr(config, 'download_preallocate', False),
+            fsync=getattr(config, 'download_fsync', True),
+            )
+
+    def get_retry_policy(self, max_attempts):
+        return retry.RetryPolicy(
+            max_attempts=max(1, max_attempts),
+            backoff_base=self.backoff_base, backoff_max=self.backoff_max)
 
 
 @dataclass
@@ -22,131 +113,693 @@ class BaseDataItem:
     remote_checksum: str
     remote_checksum_type: str
 
+    size: int = None
     download_date: str = None
     download_successfull: bool = None
     _used_download_urls: list = None
 
     def __post_init__(self):
         self._file_url = None
+        self._available_file_urls = None
+        self._host = None
+        # retry.ReplicaRotation of the download (kept between jobs)
+        self._rotation = None
+        # Delay (s) and host of the next attempt of a deferred download
+        self.retry_after = None
+        self.retry_host = None
+        # (host, n_bytes, duration, error) of every download attempt
+        self._transfers = []
 
-    @property
+    @functools.cached_property
     def local_file(self):
         return self.local_dir / self.filename
 
+    @functools.cached_property
+    def local_part_file(self):
+        """File into which the data is downloaded before verification."""
+        return self.local_dir / (self.filename + PART_FILE_SUFFIX)
+
+    @functools.cached_property
+    def local_segments_file(self):
+        """File listing the finished segments of local_part_file."""
+        return self.local_dir / (
+            self.filename + PART_FILE_SUFFIX + SEGMENTS_FILE_SUFFIX)
+
+    def _remove_part_file(self):
+        """Remove local_part_file and the files describing it."""
+        file_writer.remove(self.local_part_file)
+        self.local_segments_file.unlink(missing_ok=True)
+
     @property
     def checksum_matches(self):
         return self.local_checksum == self.remote_checksum
 
     @property
     def local_checksum(self):
+        """Checksum of local_file (looked up in the checksum index)."""
+        return self._get_local_checksum()
+
+    def local_file_exists(self):
+        """Return True if local_file exists (and has the remote size).
+
+        Files in the inventory are not looked up on disk; other files
+        are and, if found, added to the inventory.
+
+        """
+        local_inventory = inventory.get_inventory()
+        if local_inventory is None:
+            return self.local_file.exists()
+        entry = local_inventory.get(self.local_file)
+        if entry is None:
+            try:
+                stat = os.stat(self.local_file)
+            except FileNotFoundError:
+                return False
+            local_inventory.add(self.local_file, stat=stat)
+            entry = local_inventory.get(self.local_file)
+        return self.size is None or entry.size == self.size
+
+    def _record_verified_checksum(self, checksum):
+        local_inventory = inventory.get_inventory()
+        if local_inventory is None:
+            return
+        entry = local_inventory.get(self.local_file)
+        if entry is None or entry.checksum != checksum:
+            local_inventory.add(
+                self.local_file, self.remote_checksum_type, checksum)
+
+    def remove_local_file(self):
+        """Remove local_file (from disk and from the inventory)."""
+        self.local_file.unlink(missing_ok=True)
+        if inventory.get_inventory() is not None:
+            inventory.get_inventory().remove(self.local_file)
+
+    def _get_local_checksum(self, force_rehash=False):
+        return checksum_index.get_checksum_index(
+            self.local_base_dir).checksum(
+                self.local_file, self.remote_checksum_type, self._checksum,
+                force_rehash=force_rehash)
+
+    def _checksum(self, path):
         if self.remote_checksum_type == 'SHA256':
-            return helper.sha256_checksum_file(self.local_file)
+            with tracing.span('checksum', filename=self.filename):
+                return helper.sha256_checksum_file(path)
         raise ValueError('Unkown checksum type!')
 
+    def _new_checksum_hash(self):
+        """Return hashlib object for remote_checksum_type or None."""
+        if self.remote_checksum_type == 'SHA256':
+            return hashlib.sha256()
+        return None
+
     @property
     def local_dir(self):
         return helper.get_local_dir(self.filename, self.local_base_dir)
 
+    def restrict_to_host(self, host):
+        """Only download from the replicas on host (e.g. chosen by the
+        scheduler, which limits the downloads per host). Replicas on
+        host are ranked first, attempts on other replicas are deferred
+        (see download)."""
+        self._host = host
+        self._file_url = None
+
+    def _is_allowed(self, url):
+        return self._host is None or host_health.get_host(url) == self._host
+
     @property
     def file_url(self):
+        """Return URL of the best available replica.
+
+        All replicas are probed in parallel and ranked by their
+        latency and the throughput of their host in the shared
+        host health table. An available replica on the host of
+        restrict_to_host is ranked first.
+
+        """
         if self._file_url is None:
-            for fu in self.file_urls:
-                try:
-                    head = requests.head(
-                        fu, allow_redirects=True, verify=False,
-                        timeout=HTTP_HEAD_TIMEOUT_TIME)
-                    if head.status_code == 200:
-                        self._file_url = fu
-                except:
-                    pass
-            if self._file_url is None:
+            with tracing.span(
+                    'probe', filename=self.filename,
+                    n_replicas=len(self.file_urls)):
+                available_urls = host_health.probe_urls(
+                    self.file_urls, host_health.get_host_health_table())
+            available_urls.sort(key=lambda u: not self._is_allowed(u))
+            self._available_file_urls = available_urls
+            if available_urls:
+                self._file_url = available_urls[0]
+            else:
                 logger.debug(f'No file URL is available!')
                 self._file_url = False
         return self._file_url
 
-    def verify_download(self, verify_checksum=False):
-        """Check if file was downloaded and optionally compare checksum."""
+    def verify_download(self, verify_checksum=False, force_rehash=False):
+        """Check if file was downloaded and optionally compare checksum.
+
+        Without verify_checksum, the file is looked up in the inventory
+        (see local_file_exists). Checksums of unchanged files are taken
+        from the checksum index, unless force_rehash is True.
+
+        """
+        with tracing.span(
+                'verify', filename=self.filename,
+                verify_checksum=verify_checksum) as span_args:
+            verified = self._verify_download(verify_checksum, force_rehash)
+            span_args['verified'] = verified
+        return verified
+
+    def _verify_download(self, verify_checksum, force_rehash):
         verified = True
-        if self.local_file.exists():
+        if verify_checksum:
+            exists = self.local_file.exists()
+        else:
+            exists = self.local_file_exists()
+        if exists:
             if verify_checksum:
-                if not self.checksum_matches:
+                local_checksum = self._get_local_checksum(
+                    force_rehash=force_rehash)
+                checksum_index.get_checksum_index(
+                    self.local_base_dir).set_remote(
+                        self.filename, self.remote_checksum_type,
+                        self.remote_checksum)
+                if local_checksum != self.remote_checksum:
                     verified = False
                     logger.debug(f'Local and remote checksum do no match.')
+                else:
+                    self._record_verified_checksum(local_checksum)
         else:
             logger.debug(f'File does not exist locally.')
             verified = False
         return verified
 
-    def _http_get(self):
-        """Make HTTP request for this data item and store it locally."""
-        with requests.get(
+    def _http_get(self, settings=None):
+        """Make HTTP request for this data item and store it locally.
+
+        The data is written to local_part_file. If this file already
+        exists (from an interrupted download), only the missing bytes
+        are requested using a HTTP Range request. If the server does
+        not support Range requests, the whole file is downloaded again.
+
+        Files larger than settings.segmented_download_threshold are
+        downloaded with _http_get_segmented instead.
+
+        If the file is streamed from its first byte, the checksum is
+        computed from the written chunks, so that the file does not
+        have to be read again for verification.
+
+        Returns:
+            (n_bytes, complete, checksum): Number of bytes transferred,
+                whether the transfer finished, and the checksum of the
+                streamed data (None for resumed or segmented downloads).
+
+        """
+        if settings is None:
+            settings = DownloadSettings()
+        if settings.segmented_download_threshold is not None and \
+                settings.n_download_segments > 1:
+            size = self._get_remote_size()
+            if size is not None and \
+                    size >= settings.segmented_download_threshold:
+                result = self._http_get_segmented(size, settings)
+                if result is not None:
+                    return result
+        if self.local_segments_file.exists():
+            # The part file of a segmented download has its full size
+            self._remove_part_file()
+
+        headers = {}
+        offset = file_writer.get_valid_length(self.local_part_file)
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+        n_bytes = 0
+        with http_session.get_session().get(
                 self.file_url, allow_redirects=True, verify=False,
-                timeout=HTTP_DOWNLOAD_TIMEOUT_TIME, stream=True) as r:
-            if r.status_code == 404:
-                raise requests.HTTPError(404)
+                timeout=HTTP_DOWNLOAD_TIMEOUT_TIME, stream=True,
+                headers=headers) as r:
+            if r.status_code != 416:
+                r.raise_for_status()
+                return self._stream(r, offset, settings)
+        # The part file already has the full size
+        checksum = self._checksum(self.local_part_file)
+        if checksum == self.remote_checksum:
+            return n_bytes, True, checksum
+        logger.info(f'Discard part file of {self.filename}.')
+        self._remove_part_file()
+        return self._http_get(settings=settings)
+
+    def _stream(self, r, offset, settings):
+        """Write the body of response r to local_part_file.
+
+        The body is read with file_writer.FileWriter in chunks of
+        settings.chunk_size into a buffer of settings.buffer_size.
+
+        Returns:
+            (n_bytes, complete, checksum): See _http_get.
+
+        """
+        mode = 'wb'
+        checksum_hash = self._new_checksum_hash()
+        if offset > 0 and r.status_code == 206:
+            logger.info(
+                f'Resume download of {self.filename} at byte {offset}.')
+            mode = 'ab'
+            checksum_hash = None
+        else:
+            offset = 0
+        expected = r.headers.get('Content-Length')
+        expected = None if expected is None else int(expected)
+        host = host_health.get_host(self.file_url)
+        readinto = file_writer.get_readinto(r)
+        n_bytes = 0
+        with tracing.span(
+                'stream', filename=self.filename) as span_args, \
+                file_writer.FileWriter(
+                    self.local_part_file, mode,
+                    size=None if expected is None or not settings.preallocate
+                    else offset + expected,
+                    buffer_size=settings.buffer_size,
+                    checksum_hash=checksum_hash, fsync=settings.fsync) as f:
+            complete = True
             try:
-                with open(self.local_file, 'wb') as f:
-                    for chunk in r.iter_content(REQUESTS_CHUNK_SIZE):
-                        if not chunk:
-                            break
-                        f.write(chunk)
-            except requests.exceptions.ChunkedEncodingError as e:
+                while True:
+                    n = f.readinto(readinto, settings.chunk_size)
+                    if not n:
+                        break
+                    metrics.add_received_bytes(n)
+                    bandwidth.throttle(host, n)
+                    n_bytes += n
+                file_writer.release_connection(r)
+            except (socket.timeout,
+                    urllib3.exceptions.ReadTimeoutError) as e:
+                raise requests.exceptions.ReadTimeout(e) from e
+            except file_writer.READ_ERRORS as e:
                 logger.warning(
                     f'Could not finish download of {self.file_url} ({e})')
+                complete = False
+            if expected is not None and n_bytes != expected:
+                complete = False
+            f.close(complete=complete)
+            # Time spent on disk writes and hashing (the rest of the
+            # span is spent waiting for the network).
+            span_args.update(
+                n_bytes=n_bytes, write_seconds=f.write_seconds,
+                hash_seconds=f.hash_seconds)
+        if not complete:
+            if expected is not None and n_bytes < expected:
+                logger.warning(
+                    f'Download of {self.file_url} ended after {n_bytes} '
+                    f'of {expected} bytes.')
+            return n_bytes, False, None
+        if checksum_hash is None:
+            return n_bytes, True, None
+        return n_bytes, True, checksum_hash.hexdigest()
+
+    def _get_remote_size(self):
+        """Return file size from the search result or a HEAD request."""
+        if self.size is not None:
+            return self.size
+        try:
+            head = http_session.get_session().head(
+                self.file_url, allow_redirects=True, verify=False,
+                timeout=host_health.HTTP_PROBE_TIMEOUT_TIME)
+            return int(head.headers['Content-Length'])
+        except (requests.exceptions.RequestException, KeyError,
+                ValueError):
+            return None
+
+    def _http_get_segmented(self, size, settings):
+        """Download the file in byte ranges concurrently.
+
+        The file is split into settings.n_download_segments segments.
+        local_part_file is preallocated to size and every segment is
+        written at its offset. The segments are distributed over all
+        available replicas (on the host of restrict_to_host, without
+        those which failed fatally before); a failed segment is retried
+        once on every other replica.
+
+        Finished segments are listed in local_segments_file, so that
+        a failed or killed download only requests the missing segments
+        in its next attempt.
+
+        Returns:
+            (n_bytes, complete, None) or None if the server does not
+                support Range requests or local_part_file was started
+                by a single stream (the caller then falls back to a
+                single stream).
+
+        """
+        fatal = self._rotation.fatal if self._rotation else ()
+        urls = [
+            u for u in self._available_file_urls or [self.file_url]
+            if self._is_allowed(u) and u not in fatal] or [self.file_url]
+        segment_size = -(-size // settings.n_download_segments)
+        segments = [
+            [start, min(start+segment_size, size) - 1]
+            for start in range(0, size, segment_size)]
+        state = {'size': size, 'segments': segments, 'done': []}
+        if self.local_segments_file.exists():
+            try:
+                previous = json.loads(self.local_segments_file.read_text())
+                if previous['size'] == size and \
+                        previous['segments'] == segments:
+                    state = previous
+            except (ValueError, TypeError, KeyError):
+                pass
+            if not self.local_part_file.exists() or \
+                    self.local_part_file.stat().st_size != size:
+                # E.g. removed by remove_tmp_files: nothing is done
+                state = {'size': size, 'segments': segments, 'done': []}
+            if state['done'] == []:
+                self._remove_part_file()
+        elif self.local_part_file.exists():
+            # Resume the single stream instead
+            return None
+        if not self.local_part_file.exists():
+            with open(self.local_part_file, 'wb') as f:
+                if not settings.preallocate or \
+                        not file_writer.preallocate(f.fileno(), 0, size):
+                    f.truncate(size)
+            self.local_segments_file.write_text(json.dumps(state))
+        missing = [s for s in segments if s not in state['done']]
+        lock = threading.Lock()
+
+        def get_segment(i):
+            start, end = missing[i]
+            for j in range(len(urls)):
+                url = urls[(i+j) % len(urls)]
+                try:
+                    with http_session.get_session().get(
+                            url, allow_redirects=True, verify=False,
+                            timeout=HTTP_DOWNLOAD_TIMEOUT_TIME, stream=True,
+                            headers={'Range': f'bytes={start}-{end}'}) as r:
+                        if r.status_code == 200:
+                            return None
+                        r.raise_for_status()
+                        content_range = r.headers.get('Content-Range', '')
+                        if not content_range.startswith(
+                                f'bytes {start}-{end}/'):
+                            logger.warning(
+                                f'Segment {start}-{end} of {url} has the '
+                                f'wrong range ({content_range}).')
+                            continue
+                        n_bytes = 0
+                        length = end - start + 1
+                        readinto = file_writer.get_readinto(r)
+                        with file_writer.FileWriter(
+                                self.local_part_file, 'r+b', offset=start,
+                                buffer_size=settings.buffer_size,
+                                fsync=False) as f:
+                            # Never write into the next segment
+                            while n_bytes < length:
+                                n = f.readinto(readinto, min(
+                                    settings.chunk_size, length - n_bytes))
+                                if not n:
+                                    break
+                                metrics.add_received_bytes(n)
+                                bandwidth.throttle(
+                                    host_health.get_host(url), n)
+                                n_bytes += n
+                        file_writer.release_connection(r)
+                        if n_bytes == length:
+                            with lock:
+                                state['done'].append([start, end])
+                                self.local_segments_file.write_text(
+                                    json.dumps(state))
+                            return n_bytes
+                except file_writer.READ_ERRORS as e:
+                    logger.warning(
+                        f'Segment {start}-{end} of {url} failed ({e}).')
+            return False
+
+        logger.info(
+            f'Download {self.filename} in {len(missing)} of '
+            f'{len(segments)} segments from {len(urls)} replicas.')
+        with ThreadPoolExecutor(max_workers=max(1, len(missing))) as ex:
+            results = list(ex.map(get_segment, range(len(missing))))
+        if None in results:
+            logger.info(
+                'Server does not support Range requests, fall back '
+                'to a single stream.')
+            self._remove_part_file()
+            return None
+        n_bytes = sum(r for r in results if r)
+        if False in results:
+            # The finished segments are kept for the next attempt
+            return n_bytes, False, None
+        if settings.fsync:
+            with open(self.local_part_file, 'rb') as f:
+                os.fsync(f.fileno())
+        self.local_segments_file.unlink()
+        return n_bytes, True, None
+
+    def _finalize_part_file(self, checksum=None):
+        """Move local_part_file to local_file if its checksum matches.
+
+        A part file with a wrong checksum is removed, so that the next
+        attempt starts from scratch.
+
+        Args:
+            checksum (str): Checksum computed while downloading. If
+                None, local_part_file is hashed.
+
+        """
+        try:
+            if checksum is None:
+                checksum = self._checksum(self.local_part_file)
+            if checksum == self.remote_checksum:
+                with tracing.span('finalize', filename=self.filename):
+                    os.replace(self.local_part_file, self.local_file)
+        except FileNotFoundError:
+            # Another download of the same file finished it first
+            return self.local_file.exists()
+        if checksum == self.remote_checksum:
+            index = checksum_index.get_checksum_index(self.local_base_dir)
+            index.set(self.local_file, self.remote_checksum_type, checksum)
+            index.set_remote(
+                self.filename, self.remote_checksum_type,
+                self.remote_checksum)
+            self._record_verified_checksum(checksum)
+            return True
+        logger.warning(
+            f'Checksum of downloaded file {self.filename} does not match.')
+        self._remove_part_file()
+        return False
+
+    def get_download_urls(self):
+        """Return the URLs of all replicas in the order they are tried.
+
+        Available replicas come first (ranked as in file_url), the
+        others (e.g. whose probe timed out) are kept as a last resort.
+
+        """
+        self.file_url
+        urls = list(self._available_file_urls or [])
+        return urls + [u for u in self.file_urls if u not in urls]
 
     def download(
-            self, max_attempts=1, attempt=1, reverify_checksum=False,
-            redownload=False):
+            self, max_attempts=1, reverify_checksum=False, redownload=False,
+            settings=None, defer_retries=False):
         """
         High level download method that also checks if it is neccessary 
         to download the file again etc.
+
+        The file is downloaded with at most max_attempts attempts in
+        total. Every attempt uses the next replica, failed replicas
+        are retried with exponential backoff, and replicas which do not
+        have the file (e.g. 404) are not retried at all (see
+        retry.ReplicaRotation).
+
+        Kwargs:
+            settings (DownloadSettings): Tunable download parameters.
+            defer_retries (bool): Instead of waiting for the backoff
+                delay of the next attempt (or making it on another host
+                than the one of restrict_to_host), return None and set
+                retry_after and retry_host. The caller can then call
+                download again later (e.g. in another job of the
+                scheduler), which continues with the next attempt.
+
         """
+        if settings is None:
+            settings = DownloadSettings()
         if self._used_download_urls is None:
             self._used_download_urls = []
         if redownload:
-            pass
+            self._remove_part_file()
         elif self.verify_download(verify_checksum=reverify_checksum):
             return self.local_file
-        if self.local_file.exists():
-            self.local_file.unlink()
+        self.remove_local_file()
         self.local_dir.mkdir(exist_ok=True, parents=True)
 
+        # The replicas are probed here, i.e. before any transfer is
+        # timed, so that the throughput recorded for a host only covers
+        # the transfer (see _download_attempt).
+        urls = self.get_download_urls()
+        if self._rotation is None:
+            self._rotation = retry.ReplicaRotation(
+                urls, settings.get_retry_policy(max_attempts))
+        rotation = self._rotation
+        self.retry_after = self.retry_host = None
+        for url, delay in iter(rotation.next, None):
+            if defer_retries and (delay > 0 or not self._is_allowed(url)):
+                rotation.defer()
+                self.retry_after = delay
+                self.retry_host = host_health.get_host(url)
+                logger.info(
+                    f'Defer attempt {rotation.n_attempts+1} of '
+                    f'{rotation.policy.max_attempts} of {self.filename} '
+                    f'with {url} by {delay:.1f}s.')
+                return None
+            if rotation.n_attempts > 1:
+                logger.warning(
+                    f'Download or verification failed. Retry with {url} '
+                    f'in {delay:.1f}s (attempt {rotation.n_attempts} of '
+                    f'{rotation.policy.max_attempts}).')
+                time.sleep(delay)
+            error = self._download_attempt(url, rotation.n_attempts, settings)
+            if error is None:
+                logger.info(f'Download of {self.filename} successfull.')
+                return self.local_file
+            rotation.record_failure(url, error)
+        if rotation.urls and len(rotation.fatal) == len(rotation.urls):
+            logger.warning(
+                f'Failed. {self.filename} is not available on any replica.')
+        else:
+            logger.warning(f'Failed. Exceeded max number of attempts.')
+
+    def _download_attempt(self, url, attempt, settings):
+        """Download the file once from url (set as file_url).
+
+        Returns:
+            error (str): Category of the error (see classify_error) or
+                'incomplete' or 'checksum', None if the file was
+                downloaded and verified.
+
+        """
+        self._file_url = url
+        host = host_health.get_host(url)
+        self._used_download_urls.append(url)
+        t0 = time.monotonic()
+        n_bytes, complete, checksum, error = 0, False, None, None
         try:
-            self._used_download_urls.append(self.file_url)
-            if self.file_url:
-                self._http_get()
+            with tracing.span(
+                    'transfer', filename=self.filename, url=url,
+                    attempt=attempt):
+                n_bytes, complete, checksum = self._http_get(
+                    settings=settings)
         except (requests.HTTPError, requests.exceptions.ConnectionError,
                 requests.exceptions.ReadTimeout) as e:
             logger.error(e)
-
-        if self.verify_download(verify_checksum=True):
-            logger.info(f'Download of {self.filename} successfull.')
+            error = classify_error(e)
+            if error in host_health.HOST_ERRORS:
+                host_health.get_host_health_table().record_failure(host)
+        duration = time.monotonic() - t0
+        if error is None and not complete:
+            error = 'incomplete'
+        if error is None and not self._finalize_part_file(checksum):
+            error = 'checksum'
+        self._transfers.append((host, n_bytes, duration, error))
+        metrics.record_transfer(host, n_bytes, duration, error)
+        if error is None:
+            host_health.get_host_health_table().record_transfer(
+                host, n_bytes, duration)
             self.download_date = datetime.datetime.now()
-            return self.local_file
-        else:
-            logger.info(f'Try to re-download... (attempt {attempt})')
-            if attempt < max_attempts:
-                if self.local_file.exists():
-                    logger.warning(
-                        f'Local file exists but is going to be deleted')
-                    self.local_file.unlink()
-                logger.warning(
-                    'Download successfull but verification failed. '
-                    f'Try to redownload ({attempt}th attempt).')
-                return self.download(
-                    max_attempts=max_attempts, attempt=attempt+1)
-            logger.warning(f'Failed. Exceeded max number of attempts.')
+        return error
 
 
 @dataclass(unsafe_hash=True)
 class CMIP6DataItem(BaseDataItem):
     cmip6_api_search_call: str = None
     query_file: str = None
+    # Names of all queries whose results contain this file
+    matched_queries: list = None
 
-    @property
+    @functools.cached_property
     def metadata(self):
-        return helper.get_metadata_from_filename(self.filename)
+        """Facets of the filename (helper.FilenameMetadata)."""
+        return helper.parse_filename(self.filename)
+
+    @functools.cached_property
+    def local_dir(self):
+        return helper.get_local_dir(
+            self.filename, self.local_base_dir, metadata=self.metadata)
 
     @property
     def institution_filename_str(self):
         return f'[{self.metadata}] {self.filename}'
+
+
+class DataItemIndex:
+    """Index of the data items of all queries.
+
+    A file can be found by several queries (e.g. by overlapping query
+    blocks or the additional queries of min_number_of_members). The
+    index keeps a single data item per local file, merges the replica
+    URLs found by different queries into it and remembers the names of
+    all matching queries. Each file is then only verified and
+    downloaded once, with the highest priority of its queries.
+
+    If a file is found with different checksums (e.g. different
+    versions of a dataset), which would be downloaded to the same local
+    file, only the version found by the query with the highest priority
+    (the first one if equal) is kept. Only the queries (and priorities)
+    of the kept version are merged.
+
+    """
+    def __init__(self):
+        self._data_items = {}
+        self._priorities = {}
+
+    def __len__(self):
+        return len(self._data_items)
+
+    def __iter__(self):
+        return iter(self._data_items.values())
+
+    @staticmethod
+    def get_key(data_item):
+        return data_item.local_file
+
+    def add(self, data_item, query=None):
+        """Add data_item found by query and return the indexed item."""
+        key = self.get_key(data_item)
+        indexed_data_item = self._data_items.get(key)
+        if indexed_data_item is None:
+            indexed_data_item = self._data_items[key] = data_item
+            indexed_data_item.matched_queries = []
+        elif indexed_data_item.remote_checksum != data_item.remote_checksum:
+            indexed_data_item = self._select_version(
+                key, indexed_data_item, data_item, query)
+            if indexed_data_item is not data_item:
+                # The query only found the dropped version
+                return indexed_data_item
+        else:
+            for url in data_item.file_urls:
+                if url not in indexed_data_item.file_urls:
+                    indexed_data_item.file_urls.append(url)
+        if query is not None:
+            if query.name not in indexed_data_item.matched_queries:
+                indexed_data_item.matched_queries.append(query.name)
+            self._priorities[key] = max(
+                query.priority, self._priorities.get(key, query.priority))
+        return indexed_data_item
+
+    def _select_version(self, key, indexed_data_item, data_item, query):
+        """Return the version of a file which is kept in the index."""
+        priority = self._priorities.get(key)
+        if query is not None and priority is not None and \
+                query.priority > priority:
+            # Only the queries which found this version are merged
+            data_item.matched_queries = []
+            del self._priorities[key]
+            self._data_items[key] = data_item
+            kept, dropped = data_item, indexed_data_item
+        else:
+            kept, dropped = indexed_data_item, data_item
+        logger.warning(
+            f'{data_item.filename} was found with different checksums '
+            f'(different versions?). Keep {kept.remote_checksum}, drop '
+            f'{dropped.remote_checksum}.')
+        return kept
+
+    def get_priority(self, data_item, default=None):
+        """Return the highest priority of the queries of data_item."""
+        return self._priorities.get(self.get_key(data_item), default)
@@ -0,0 +1,246 @@
+import http.client
+import os
+from pathlib import Path
+import socket
+import time
+
+import requests
+import urllib3
+
+
+# Bytes requested from the network per read
+DEFAULT_CHUNK_SIZE = 1024**2
+# Bytes collected before they are written to disk (one write call)
+DEFAULT_BUFFER_SIZE = 8 * 1024**2
+# Errors of the connection while a response body is read
+READ_ERRORS = (
+    ConnectionError, socket.timeout, http.client.HTTPException,
+    urllib3.exceptions.HTTPError, requests.exceptions.RequestException)
+# Suffix of the file holding the number of valid bytes of a
+# preallocated file
+LENGTH_SUFFIX = '.len'
+
+
+def get_readinto(response):
+    """Return a readinto function for the body of a streamed response.
+
+    Bodies without Content-Encoding are read directly from the
+    http.client response into the given buffer, i.e. without creating
+    a bytes object per chunk. Other bodies are read (and decoded) by
+    urllib3, which copies every chunk. See release_connection.
+
+    Args:
+        response (requests.Response): Response of a request with
+            stream=True.
+
+    """
+    fp = getattr(response.raw, '_fp', None)
+    encoding = response.headers.get('Content-Encoding', 'identity')
+    if encoding.lower() == 'identity' and \
+            isinstance(fp, http.client.HTTPResponse):
+        return fp.readinto
+    return response.raw.readinto
+
+
+def release_connection(response):
+    """Return the connection of a completely read response to the pool.
+
+    A body read with the readinto of get_readinto bypasses urllib3, so
+    requests does not know that it was consumed and would close the
+    connection together with the response. Call this once readinto
+    returned 0 (the end of the body) to keep the connection alive.
+
+    """
+    fp = getattr(response.raw, '_fp', None)
+    if isinstance(fp, http.client.HTTPResponse) and not fp.isclosed():
+        # The body was not read completely
+        return
+    response._content_consumed = True
+    response.raw.release_conn()
+
+
+def preallocate(fd, offset, length):
+    """Reserve length bytes at offset of the file fd (if supported).
+
+    Returns:
+        True if the space was allocated.
+
+    """
+    if length <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, offset, length)
+    except OSError:
+        # Not supported by the filesystem
+        return False
+    return True
+
+
+def get_length_file(path):
+    """Return the file holding the valid length of path."""
+    return Path(f'{path}{LENGTH_SUFFIX}')
+
+
+def get_valid_length(path):
+    """Return the number of valid bytes at the start of path.
+
+    This is the size of path, unless a writer preallocated path and did
+    not truncate it (e.g. since the process was killed). Then the
+    number of bytes written is read from the length file of path.
+
+    """
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+    try:
+        return min(size, int(get_length_file(path).read_text()))
+    except (FileNotFoundError, ValueError):
+        return size
+
+
+def remove(path):
+    """Remove path and its length file (if they exist)."""
+    Path(path).unlink(missing_ok=True)
+    get_length_file(path).unlink(missing_ok=True)
+
+
+class FileWriter:
+    """Buffered writer of a downloaded file.
+
+    Data is read (see readinto) or copied (see write) into a
+    preallocated buffer, which is hashed and written to disk in a
+    single call whenever it is full. Hence the number of system calls
+    and allocations does not depend on the chunk size of the network.
+
+    If the final size of the file is known, its space is reserved with
+    posix_fallocate, so that the file is not fragmented on parallel
+    filesystems. The reserved but unwritten space is truncated when the
+    writer is closed, so that the size of an incomplete file is the
+    number of bytes received (as required to resume the download).
+    Until then, the number of bytes written is kept in the length file
+    (see get_valid_length), so that a file of a killed process is
+    resumed at the right offset as well.
+
+    Args:
+        path (str or pathlib.Path): File to write.
+        mode (str): 'wb' (new file), 'ab' (append after the valid
+            length) or 'r+b' (write at offset).
+        offset (int): Position of the first byte in mode 'r+b'.
+        size (int): Expected size of the complete file (or None).
+        buffer_size (int): Size of the buffer in bytes.
+        checksum_hash: hashlib object which is updated with all
+            written data (or None).
+        fsync (bool): Whether the data is flushed to disk (os.fsync)
+            when a complete file is closed.
+
+    Attrs:
+        n_bytes (int): Number of bytes written by this writer.
+        write_seconds (float): Time spent writing to disk.
+        hash_seconds (float): Time spent hashing.
+
+    """
+    def __init__(
+            self, path, mode='wb', offset=None, size=None,
+            buffer_size=DEFAULT_BUFFER_SIZE, checksum_hash=None,
+            fsync=True):
+        # Unbuffered, every flush is a single write call. Appending is
+        # done by seeking, since O_APPEND would write behind the
+        # preallocated space.
+        if mode == 'ab':
+            offset = get_valid_length(path)
+        elif mode == 'wb':
+            get_length_file(path).unlink(missing_ok=True)
+        self._file = open(path, 'r+b' if mode == 'ab' else mode, buffering=0)
+        if offset is not None:
+            self._file.seek(offset)
+        if mode == 'ab':
+            self._file.truncate(offset)
+        self.checksum_hash = checksum_hash
+        self.fsync = fsync
+        self.n_bytes = 0
+        self.write_seconds = self.hash_seconds = 0
+        self._buffer = memoryview(bytearray(max(1, buffer_size)))
+        self._position = 0
+        self._length_file = None
+        if size is not None and mode != 'r+b':
+            start = self._file.tell()
+            self._length_file = get_length_file(path)
+            self._length_file.write_text(str(start))
+            if not preallocate(self._file.fileno(), start, size - start):
+                self._length_file.unlink()
+                self._length_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=False)
+
+    def readinto(self, readinto, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Read up to chunk_size bytes with readinto into the buffer.
+
+        Args:
+            readinto (callable): Function filling a buffer and
+                returning the number of bytes (see get_readinto).
+
+        Returns:
+            n_bytes (int): Number of bytes read (0 at the end).
+
+        """
+        if self._position == len(self._buffer):
+            self.flush()
+        end = min(self._position + chunk_size, len(self._buffer))
+        n_bytes = readinto(self._buffer[self._position:end]) or 0
+        self._position += n_bytes
+        return n_bytes
+
+    def write(self, data):
+        """Copy data into the buffer (written when it is full)."""
+        data = memoryview(data)
+        while len(data):
+            if self._position == len(self._buffer):
+                self.flush()
+            n_bytes = min(len(data), len(self._buffer) - self._position)
+            self._buffer[self._position:self._position+n_bytes] = \
+                data[:n_bytes]
+            self._position += n_bytes
+            data = data[n_bytes:]
+
+    def flush(self):
+        """Hash and write the buffered data."""
+        data = self._buffer[:self._position]
+        t0 = time.perf_counter()
+        if self.checksum_hash is not None:
+            self.checksum_hash.update(data)
+        t1 = time.perf_counter()
+        while len(data):
+            data = data[self._file.write(data):]
+        self.write_seconds += time.perf_counter() - t1
+        self.hash_seconds += t1 - t0
+        self.n_bytes += self._position
+        self._position = 0
+        if self._length_file is not None:
+            self._length_file.write_text(str(self._file.tell()))
+
+    def close(self, complete=True):
+        """Write the remaining data and close the file.
+
+        Args:
+            complete (bool): Whether the file is complete, i.e. it is
+                flushed to disk if fsync is set.
+
+        """
+        if self._file.closed:
+            return
+        try:
+            self.flush()
+            if self._length_file is not None:
+                self._file.truncate(self._file.tell())
+                self._length_file.unlink(missing_ok=True)
+            if complete and self.fsync:
+                t0 = time.perf_counter()
+                os.fsync(self._file.fileno())
+                self.write_seconds += time.perf_counter() - t0
+        finally:
+            self._file.close()
@@ -1,9 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import re
 from itertools import product
 import hashlib
 import logging
+import os
 from pathlib import Path
-import operator
+import time
+from typing import NamedTuple
 
 
 LOGGER_LEVEL = logging.INFO
@@ -18,6 +21,37 @@ METADATA_FILENAME_LIST = [
     'time_range',
     ]
 
+# Facets (in this order) which make up the local directory of a file
+LOCAL_DIR_FACETS = [
+    'variable_id', 'table_id', 'experiment_id', 'source_id', 'member_id',
+    'grid_label']
+
+MEMBER_ID_PATTERN = re.compile(r'r(\d*)i(\d*)p(\d*)f(\d*)')
+
+# Number of threads scanning directories (see scandir_nc_files)
+N_SCAN_WORKERS = 16
+
+
+class FilenameMetadata(NamedTuple):
+    """Facets of a CMIP6 filename (see METADATA_FILENAME_LIST).
+
+    Facets missing in the filename (e.g. time_range of fx files) are
+    None.
+
+    """
+    variable_id: str = None
+    table_id: str = None
+    source_id: str = None
+    experiment_id: str = None
+    member_id: str = None
+    grid_label: str = None
+    time_range: str = None
+    filename: str = None
+
+    def as_dict(self):
+        """Return the facets found in the filename as dict."""
+        return {k: v for k, v in self._asdict().items() if v is not None}
+
 
 def get_logger(logger_name):
     logger = logging.getLogger(logger_name)
@@ -58,19 +92,59 @@ def sha256_checksum_file(path, block_size=65536):
 
 
 def get_all_nc_files_in_directory(base_directory):
-    p = Path(base_directory)
-    files = []
-    for f in p.glob('**/*'):
-        if f.is_file() and f.name.endswith('.nc'):
-            files.append(f)
-    return files
+    return [Path(path) for path, _ in scandir_nc_files(base_directory)]
+
 
+def scandir_nc_files(base_directory, n_workers=N_SCAN_WORKERS):
+    """Yield (path, os.stat_result) of all .nc files below base_directory.
+
+    Uses os.scandir, which (unlike Path.glob) gets the file type
+    without an additional stat call per entry. Every directory is
+    scanned by one of n_workers threads, so that the metadata requests
+    of a parallel filesystem are issued concurrently.
+
+    """
+    def scan(directory):
+        files, subdirectories = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file() and entry.name.endswith('.nc'):
+                        files.append((entry.path, entry.stat()))
+        except (FileNotFoundError, PermissionError):
+            pass
+        return files, subdirectories
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as ex:
+        pending = {ex.submit(scan, str(base_directory))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                pending.update(ex.submit(scan, d) for d in subdirectories)
+                yield from files
+
+
+def remove_tmp_files(base_directory, part_file_max_age=7*24*3600):
+    """Remove tmp files and stale partial downloads.
+
+    Partial downloads (.part files) are considered stale if they were
+    not modified within the last part_file_max_age seconds (a more
+    recent .part file may still be resumed or currently downloaded).
 
-def remove_tmp_files(base_directory):
+    """
     p = Path(base_directory)
     files = []
+    now = time.time()
     for f in p.glob('**/*'):
-        if f.is_file() and f.name.endswith('.tmp'):
+        if not f.is_file():
+            continue
+        if f.name.endswith('.tmp'):
+            files.append(f)
+        elif f.name.endswith(('.part', '.part.len', '.part.segments')) and \
+                now - f.stat().st_mtime > part_file_max_age:
             files.append(f)
     if not files:
         print('No tmp files found.')
@@ -107,29 +181,28 @@ def dict_product(d):
         yield dict(zip(keys, prod))
 
 
-def get_local_dir(filename, local_data_dir):
-    metadata = get_metadata_from_filename(filename)
-    try:
-        subdir_names = [
-            metadata['variable_id'], metadata['table_id'],
-            metadata['experiment_id'], metadata['source_id'],
-            metadata['member_id'], metadata['grid_label'],
-            ]
-        return Path(local_data_dir).joinpath(*subdir_names)
-    except KeyError:
+def get_local_dir(filename, local_data_dir, metadata=None):
+    if metadata is None:
+        metadata = parse_filename(filename)
+    subdir_names = [getattr(metadata, facet) for facet in LOCAL_DIR_FACETS]
+    if None in subdir_names:
         logger.debug(f'Could not retrieve local dir from given filename.')
+        return None
+    return Path(local_data_dir).joinpath(*subdir_names)
+
+
+def parse_filename(filename):
+    """Return the FilenameMetadata of a CMIP6 filename."""
+    facets = filename.split('.')[0].split('_')
+    return FilenameMetadata(
+        *facets[:len(METADATA_FILENAME_LIST)], filename=filename)
 
 
 def get_metadata_from_filename(filename):
-    metadata = dict(
-        zip(METADATA_FILENAME_LIST,
-        filename.split('.')[0].split('_'),
-        )
-    )
+    metadata = parse_filename(filename).as_dict()
     if not metadata['member_id'].startswith('r'):
         print(filename)
         print(metadata)
-    metadata['filename'] = filename
     return metadata
 
 
@@ -165,15 +238,11 @@ def sort_member_id_str(member_ids):
         k > n > l > m
 
     """
-    print(member_ids)
-    pattern = 'r(\d*)i(\d*)p(\d*)f(\d*)'
-    member_parameters = []
-    for mstr in member_ids:
+    def key(mstr):
         rxixpxfx = mstr
         if '-' in rxixpxfx:
             rxixpxfx = mstr.split('-')[-1]
-        member_parameters.append(
-            [int(x) for x in re.match(pattern, rxixpxfx).groups()] + [mstr])
-    member_parameters.sort(
-        key = operator.itemgetter(0, 2, 1, 3))
-    return [m[-1] for m in member_parameters]
+        k, l, m, n = [
+            int(x) for x in MEMBER_ID_PATTERN.match(rxixpxfx).groups()]
+        return k, m, l, n
+    return sorted(member_ids, key=key)
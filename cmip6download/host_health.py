@@ -0,0 +1,333 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import json
+import os
+from pathlib import Path
+import threading
+import time
+import urllib
+
+import requests
+
+from cmip6download import helper
+from cmip6download import http_session
+from cmip6download import retry
+
+
+logger = helper.get_logger(__file__)
+
+
+HTTP_PROBE_TIMEOUT_TIME = (10, 30)
+# After the first successful probe, slower probes are waited for at
+# least this long (in seconds) before the replicas are ranked.
+PROBE_GRACE_TIME = 1.0
+# Hosts with at least this many consecutive failures are considered
+# dead for DEAD_HOST_TIME seconds after their last failure.
+MAX_CONSECUTIVE_FAILURES = 3
+DEAD_HOST_TIME = 6 * 3600
+# Weight of a new measurement in the exponential moving averages.
+EWMA_ALPHA = 0.3
+# Error categories (see data_item.classify_error) which count as a
+# failure of the host. Others (e.g. 404) only concern a single file.
+HOST_ERRORS = ('timeout', 'connection', 'server_error')
+# File size used to turn throughput into an expected transfer time.
+REFERENCE_FILE_SIZE = 100 * 1024**2
+# Minimum time (in seconds) between two saves of save_periodically.
+SAVE_INTERVAL = 300
+# Key of the update time of every group of fields of a host entry
+FIELD_GROUPS = {
+    'latency_updated': ('latency',),
+    'throughput_updated': ('throughput',),
+    'failures_updated': ('consecutive_failures', 'last_failure')}
+
+
+def get_host(url):
+    return urllib.parse.urlparse(url).netloc
+
+
+def _ewma(old, new):
+    if old is None:
+        return new
+    return (1 - EWMA_ALPHA) * old + EWMA_ALPHA * new
+
+
+def _merge_entry(entry, other):
+    """Update every field group of entry which is newer in other."""
+    for key, fields in FIELD_GROUPS.items():
+        # Entries saved before the groups had their own update time
+        other_updated = other.get(key, other.get('updated', 0))
+        if other_updated > entry.get(key, entry.get('updated', 0)):
+            for field in fields:
+                entry[field] = other.get(field)
+            entry[key] = other_updated
+    entry['updated'] = max(entry.get('updated', 0), other.get('updated', 0))
+
+
+class HostHealthTable:
+    """Latency, throughput and failure statistics of data nodes.
+
+    The table is shared by all data items of a run and can be saved
+    to and loaded from a JSON file so that dead or slow data nodes are
+    known before the first file of the next run is tried.
+
+    Worker processes keep a journal of their observations (see
+    start_journal), which is sent to the main process and applied to
+    its table (see apply_journal), so that the main process can save
+    the observations of all workers.
+
+    Args:
+        path (str or pathlib.Path): JSON file the table is stored in.
+            If None, the table is kept in memory only.
+
+    """
+    def __init__(self, path=None):
+        self.path = None if path is None else Path(path)
+        self.hosts = {}
+        self._lock = threading.Lock()
+        self._last_save = time.monotonic()
+        self._journal = None
+
+    @classmethod
+    def load(cls, path):
+        table = cls(path)
+        try:
+            with open(path, 'r') as f:
+                table.hosts = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning(f'Could not read host health table {path} ({e}).')
+        return table
+
+    def save(self):
+        """Merge the table with the one on disk and save it.
+
+        For every host, the most recently updated latency, throughput
+        and failure counts are kept (see FIELD_GROUPS), so that several
+        processes can save their observations.
+
+        """
+        if self.path is None:
+            return
+        on_disk = HostHealthTable.load(self.path).hosts
+        with self._lock:
+            for host, entry in on_disk.items():
+                _merge_entry(self._entry(host), entry)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(
+                f'{self.path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.hosts, f, indent=1)
+            os.replace(tmp_path, self.path)
+            self._last_save = time.monotonic()
+
+    def save_periodically(self):
+        """Save the table if it was not saved within SAVE_INTERVAL."""
+        if time.monotonic() - self._last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def start_journal(self):
+        """Record all observations from now on (see pop_journal)."""
+        with self._lock:
+            self._journal = []
+
+    def pop_journal(self):
+        """Return and clear the observations since the last call."""
+        with self._lock:
+            journal = self._journal or []
+            if self._journal is not None:
+                self._journal = []
+        return journal
+
+    def apply_journal(self, journal):
+        """Apply the observations of another table (see pop_journal)."""
+        for name, *args in journal:
+            if name in ('record_success', 'record_failure',
+                        'record_transfer'):
+                getattr(self, name)(*args)
+
+    def _entry(self, host):
+        return self.hosts.setdefault(host, {
+            'latency': None, 'throughput': None,
+            'consecutive_failures': 0, 'last_failure': None,
+            'updated': 0, **{key: 0 for key in FIELD_GROUPS}})
+
+    def _update(self, entry, now, *keys):
+        for key in keys:
+            entry[key] = now
+        entry['updated'] = max(entry['updated'], now)
+
+    def record_success(self, host, latency, now=None):
+        now = now or time.time()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(('record_success', host, latency, now))
+            entry = self._entry(host)
+            entry['latency'] = _ewma(entry['latency'], latency)
+            entry['consecutive_failures'] = 0
+            self._update(entry, now, 'latency_updated', 'failures_updated')
+
+    def record_failure(self, host, now=None):
+        now = now or time.time()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(('record_failure', host, now))
+            entry = self._entry(host)
+            entry['consecutive_failures'] += 1
+            entry['last_failure'] = now
+            self._update(entry, now, 'failures_updated')
+
+    def record_transfer(self, host, n_bytes, duration, now=None):
+        """Record the throughput (bytes/s) of a finished download."""
+        if duration <= 0:
+            return
+        now = now or time.time()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append(
+                    ('record_transfer', host, n_bytes, duration, now))
+            entry = self._entry(host)
+            entry['throughput'] = _ewma(
+                entry['throughput'], n_bytes / duration)
+            self._update(entry, now, 'throughput_updated')
+
+    def is_dead(self, host):
+        entry = self.hosts.get(host)
+        if entry is None:
+            return False
+        return (entry['consecutive_failures'] >= MAX_CONSECUTIVE_FAILURES
+                and time.time() - entry['last_failure'] < DEAD_HOST_TIME)
+
+    def expected_time(self, host, latency=None):
+        """Return expected time (s) to fetch a file from host.
+
+        Unknown hosts are ranked by latency only.
+
+        """
+        entry = self.hosts.get(host, {})
+        if latency is None:
+            latency = entry.get('latency') or 0
+        throughput = entry.get('throughput')
+        if throughput:
+            return latency + REFERENCE_FILE_SIZE / throughput
+        return latency
+
+    def rank_urls(self, urls, latencies=None):
+        """Return urls sorted from best to worst host.
+
+        Args:
+            urls (list[str]): URLs to rank.
+            latencies (dict): Measured latency (s) per URL, if
+                not given, the latency stored in the table is used.
+
+        """
+        latencies = latencies or {}
+        return sorted(urls, key=lambda u: (
+            self.is_dead(get_host(u)),
+            self.expected_time(get_host(u), latencies.get(u))))
+
+
+def get_probe_candidates(urls, table):
+    """Return the urls which are probed (see probe_urls)."""
+    candidates = [u for u in urls if not table.is_dead(get_host(u))]
+    return candidates or list(urls)
+
+
+class ProbeResults:
+    """Results of the concurrent probes of the replicas of a file.
+
+    Every result is recorded in the host health table. As soon as the
+    first probe succeeds, the remaining probes get PROBE_GRACE_TIME (or
+    twice the latency of the first probe) to finish before the
+    available URLs are ranked (see get_timeout).
+
+    Args:
+        table (HostHealthTable): Table in which the probes are recorded.
+
+    """
+    def __init__(self, table):
+        self.table = table
+        self.latencies = {}
+        self.deadline = None
+
+    def add(self, url, latency, status_code):
+        """Record the probe of url.
+
+        Args:
+            latency (float): Duration (s) of the probe.
+            status_code (int): Status code of the response, None if
+                there was no response (e.g. connection error).
+
+        """
+        if status_code != 200:
+            # A missing file (e.g. 404) only rules out this replica
+            if status_code is None or \
+                    retry.classify_status_code(status_code) in HOST_ERRORS:
+                self.table.record_failure(get_host(url))
+            return
+        self.table.record_success(get_host(url), latency)
+        self.latencies[url] = latency
+        if self.deadline is None:
+            self.deadline = time.monotonic() + max(
+                PROBE_GRACE_TIME, 2 * latency)
+
+    def get_timeout(self):
+        """Return the time (s) left for the pending probes (or None)."""
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def rank(self):
+        """Return the available URLs, best first."""
+        return self.table.rank_urls(list(self.latencies), self.latencies)
+
+
+def probe_urls(urls, table, timeout=HTTP_PROBE_TIMEOUT_TIME):
+    """Probe urls concurrently using HTTP HEAD requests.
+
+    URLs on dead hosts are only probed if every host is dead (see
+    get_probe_candidates), the results are ranked by ProbeResults.
+
+    Returns:
+        urls (list[str]): Available URLs, best first.
+
+    """
+    candidates = get_probe_candidates(urls, table)
+    if not candidates:
+        return []
+
+    def probe(url):
+        t0 = time.monotonic()
+        try:
+            head = http_session.get_session().head(
+                url, allow_redirects=True, verify=False, timeout=timeout)
+        except requests.exceptions.RequestException:
+            return None, None
+        return time.monotonic() - t0, head.status_code
+
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    futures = {executor.submit(probe, u): u for u in candidates}
+    results = ProbeResults(table)
+    pending = set(futures)
+    while pending:
+        done, pending = wait(
+            pending, timeout=results.get_timeout(),
+            return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            results.add(futures[future], *future.result())
+    executor.shutdown(wait=False, cancel_futures=True)
+    return results.rank()
+
+
+_HOST_HEALTH_TABLE = HostHealthTable()
+
+
+def get_host_health_table():
+    """Return the host health table shared by all data items."""
+    return _HOST_HEALTH_TABLE
+
+
+def set_host_health_table(table):
+    global _HOST_HEALTH_TABLE
+    _HOST_HEALTH_TABLE = table
@@ -0,0 +1,138 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+# Number of hosts for which a connection pool is kept.
+HTTP_POOL_CONNECTIONS = 32
+# Number of keep-alive connections kept per host.
+HTTP_POOL_MAXSIZE = 16
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+# Maps host:port to [connections, requests] of this process' session
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count(host, port, n_connections=0, n_requests=0):
+    with _stats_lock:
+        counts = _stats.setdefault(f'{host}:{port}', [0, 0])
+        counts[0] += n_connections
+        counts[1] += n_requests
+
+
+class _CountingHTTPConnection(urllib3.connection.HTTPConnection):
+    """Connection counting every TCP connect, including reconnects of
+    pooled connections which were closed."""
+    def connect(self):
+        super().connect()
+        _count(self.host, self.port, n_connections=1)
+
+
+class _CountingHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        super().connect()
+        _count(self.host, self.port, n_connections=1)
+
+
+class _CountingHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+    def _make_request(self, conn, *args, **kwargs):
+        _count(self.host, self.port, n_requests=1)
+        return super()._make_request(conn, *args, **kwargs)
+
+
+class _CountingHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+    def _make_request(self, conn, *args, **kwargs):
+        _count(self.host, self.port, n_requests=1)
+        return super()._make_request(conn, *args, **kwargs)
+
+
+def configure(pool_connections=None, pool_maxsize=None):
+    """Set the pool sizes of sessions created afterwards."""
+    global HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, _session
+    if pool_connections is not None:
+        HTTP_POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        HTTP_POOL_MAXSIZE = pool_maxsize
+    _session = None
+
+
+def get_session():
+    """Return the HTTP session shared by all threads of this process.
+
+    The session keeps a pool of keep-alive connections per host, so
+    that subsequent requests to the same index or data node reuse
+    established TCP/TLS connections. Every process (e.g. every
+    download worker) gets its own session.
+
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE)
+            adapter.poolmanager.pool_classes_by_scheme = {
+                'http': _CountingHTTPConnectionPool,
+                'https': _CountingHTTPSConnectionPool}
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if _session_pid != os.getpid():
+                # Counts inherited from the parent process
+                with _stats_lock:
+                    _stats.clear()
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def get_stats():
+    """Return connection reuse statistics of this process' session.
+
+    Every TCP connect is counted (see _CountingHTTPConnection), also
+    if urllib3 reconnects a pooled connection which was closed.
+
+    Returns:
+        stats (dict): Maps every host to the number of opened
+            connections and sent requests. The key 'total'
+            additionally contains the reuse ratio (share of requests
+            which did not need a new connection).
+
+    """
+    if _session_pid != os.getpid():
+        return {}
+    with _stats_lock:
+        stats = {
+            host: {'connections': n_connections, 'requests': n_requests}
+            for host, (n_connections, n_requests) in _stats.items()}
+    n_connections = sum(v['connections'] for v in stats.values())
+    n_requests = sum(v['requests'] for v in stats.values())
+    stats['total'] = {
+        'connections': n_connections, 'requests': n_requests,
+        'reuse_ratio': (
+            max(0, 1 - n_connections / n_requests) if n_requests else 0)}
+    return stats
+
+
+def log_stats():
+    total = get_stats().get('total')
+    if total:
+        logger.info(
+            f'HTTP connections: {total["connections"]} opened for '
+            f'{total["requests"]} requests '
+            f'(reuse ratio {total["reuse_ratio"]:.2f}).')
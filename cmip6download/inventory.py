@@ -0,0 +1,169 @@
+from collections import namedtuple
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+MANIFEST_FILENAME = '.inventory.sqlite'
+SQLITE_TIMEOUT_TIME = 60
+
+
+InventoryEntry = namedtuple(
+    'InventoryEntry', ['size', 'mtime_ns', 'algorithm', 'checksum'])
+
+
+class Inventory:
+    """Manifest of the local holdings of base_data_dir.
+
+    The manifest is a sqlite database in base_data_dir with one row per
+    local file (path, size, mtime, verified checksum and the facets of
+    the filename). It is loaded once into memory, so that checking if
+    a file was already downloaded does not require a request to the
+    filesystem. It is updated whenever a file is downloaded, verified
+    or removed and can be reconciled with the filesystem (reconcile)
+    if files were changed by other tools.
+
+    Files which are not in the manifest are still looked up on disk
+    (see BaseDataItem.local_file_exists), hence an outdated manifest
+    can only miss removed files.
+
+    Args:
+        base_data_dir (str or pathlib.Path): Directory of the database.
+
+    """
+    def __init__(self, base_data_dir):
+        self.base_data_dir = Path(base_data_dir)
+        self.path = self.base_data_dir / MANIFEST_FILENAME
+        self.entries = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            local.connection = sqlite3.connect(
+                self.path, timeout=SQLITE_TIMEOUT_TIME)
+            local.pid = os.getpid()
+            facet_columns = ''.join(
+                f'{facet} TEXT, ' for facet in helper.METADATA_FILENAME_LIST)
+            with local.connection:
+                local.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS files ('
+                    'path TEXT PRIMARY KEY, filename TEXT, size INTEGER, '
+                    f'mtime_ns INTEGER, {facet_columns}algorithm TEXT, '
+                    'checksum TEXT, verified REAL)')
+        return local.connection
+
+    @classmethod
+    def load(cls, base_data_dir):
+        """Load the manifest of base_data_dir (created if missing)."""
+        inventory = cls(base_data_dir)
+        inventory.entries = {
+            path: InventoryEntry(*row)
+            for path, *row in inventory.connection.execute(
+                'SELECT path, size, mtime_ns, algorithm, checksum '
+                'FROM files')}
+        logger.debug(
+            f'Loaded inventory of {len(inventory.entries)} local files.')
+        return inventory
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        """Return the InventoryEntry of path (or None)."""
+        return self.entries.get(str(path))
+
+    @staticmethod
+    def _get_row(path, stat, algorithm=None, checksum=None):
+        filename = os.path.basename(path)
+        metadata = helper.parse_filename(filename)
+        return (
+            path, filename, stat.st_size, stat.st_mtime_ns,
+            *[getattr(metadata, f) for f in helper.METADATA_FILENAME_LIST],
+            algorithm, checksum, time.time() if checksum else None)
+
+    def _insert(self, rows):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES '
+                f'({", ".join("?" * len(rows[0]))})', rows)
+        with self._lock:
+            for row in rows:
+                self.entries[row[0]] = InventoryEntry(
+                    row[2], row[3], row[-3], row[-2])
+
+    def add(self, path, algorithm=None, checksum=None, stat=None):
+        """Add (or update) path with its current stat and checksum."""
+        path = str(path)
+        if stat is None:
+            stat = os.stat(path)
+        self._insert([self._get_row(path, stat, algorithm, checksum)])
+
+    def remove(self, *paths):
+        paths = [str(path) for path in paths]
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM files WHERE path = ?', [(p,) for p in paths])
+        with self._lock:
+            for path in paths:
+                self.entries.pop(path, None)
+
+    def reconcile(self, n_workers=helper.N_SCAN_WORKERS):
+        """Synchronise the manifest with the files on disk.
+
+        New files are added, removed files are dropped, and files
+        whose size or mtime changed lose their verified checksum.
+
+        Returns:
+            (n_added, n_changed, n_removed)
+
+        """
+        t0 = time.monotonic()
+        n_added = n_changed = 0
+        found = set()
+        rows = []
+        for path, stat in helper.scandir_nc_files(
+                self.base_data_dir, n_workers):
+            found.add(path)
+            entry = self.entries.get(path)
+            if entry is None:
+                n_added += 1
+            elif (entry.size, entry.mtime_ns) != (
+                    stat.st_size, stat.st_mtime_ns):
+                n_changed += 1
+            else:
+                continue
+            rows.append(self._get_row(path, stat))
+        if rows:
+            self._insert(rows)
+        removed = [path for path in self.entries if path not in found]
+        if removed:
+            self.remove(*removed)
+        logger.info(
+            f'Reconciled inventory with {len(found)} local files in '
+            f'{time.monotonic()-t0:.1f}s ({n_added} added, {n_changed} '
+            f'changed, {len(removed)} removed).')
+        return n_added, n_changed, len(removed)
+
+
+_INVENTORY = None
+
+
+def get_inventory():
+    """Return the inventory used by all data items (or None)."""
+    return _INVENTORY
+
+
+def set_inventory(inventory):
+    global _INVENTORY
+    _INVENTORY = inventory
@@ -0,0 +1,334 @@
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import threading
+import time
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+METRICS_PREFIX = 'cmip6download_'
+# Upper bounds of the histogram buckets (the last bucket is +Inf)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+THROUGHPUT_BUCKETS = tuple(10**e for e in range(4, 10))
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key, **extra):
+    labels = list(label_key) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms.
+
+    Every metric is identified by its name and its labels (e.g. host).
+    Every process has its own registry (see get_metrics). Worker
+    processes send their metrics to the main process as snapshots,
+    which are merged there into the registry of the main process.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # (name, label key) -> [count per bucket..., sum, count]
+        self.histograms = {}
+        self.buckets = {}
+
+    def inc(self, name, value=1, **labels):
+        key = name, _label_key(labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[name, _label_key(labels)] = value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        key = name, _label_key(labels)
+        with self._lock:
+            buckets = self.buckets.setdefault(name, buckets)
+            histogram = self.histograms.setdefault(
+                key, [0] * (len(buckets) + 3))
+            for i, upper_bound in enumerate(buckets):
+                if value <= upper_bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(buckets)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def get(self, name, **labels):
+        """Return the value of a counter (summed over unset labels)."""
+        label_key = set(_label_key(labels))
+        with self._lock:
+            return sum(
+                value for (n, k), value in self.counters.items()
+                if n == name and label_key <= set(k))
+
+    def snapshot(self, reset=False):
+        """Return the (picklable) state of all metrics."""
+        with self._lock:
+            snapshot = {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {
+                    k: list(v) for k, v in self.histograms.items()},
+                'buckets': dict(self.buckets),
+                }
+            if reset:
+                self.counters.clear()
+                self.gauges.clear()
+                self.histograms.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot (e.g. of a worker process)."""
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(snapshot['gauges'])
+            for name, buckets in snapshot['buckets'].items():
+                self.buckets.setdefault(name, buckets)
+            for key, values in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(
+                    key, [0] * len(values))
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+    def to_prometheus(self):
+        """Return all metrics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        lines = []
+        for kind in ['counters', 'gauges']:
+            metric_type = 'counter' if kind == 'counters' else 'gauge'
+            seen = set()
+            for (name, label_key), value in sorted(snapshot[kind].items()):
+                name = METRICS_PREFIX + name
+                if name not in seen:
+                    lines.append(f'# TYPE {name} {metric_type}')
+                    seen.add(name)
+                lines.append(f'{name}{_format_labels(label_key)} {value}')
+        seen = set()
+        for (name, label_key), values in sorted(
+                snapshot['histograms'].items()):
+            buckets = snapshot['buckets'][name]
+            name = METRICS_PREFIX + name
+            if name not in seen:
+                lines.append(f'# TYPE {name} histogram')
+                seen.add(name)
+            cumulative = 0
+            for upper_bound, count in zip(
+                    list(buckets) + ['+Inf'], values[:-2]):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket'
+                    f'{_format_labels(label_key, le=upper_bound)} '
+                    f'{cumulative}')
+            lines.append(f'{name}_sum{_format_labels(label_key)} '
+                         f'{values[-2]}')
+            lines.append(f'{name}_count{_format_labels(label_key)} '
+                         f'{values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """Return all metrics as JSON document."""
+        snapshot = self.snapshot()
+
+        def entries(metrics):
+            return [
+                {'name': name, 'labels': dict(label_key), 'value': value}
+                for (name, label_key), value in sorted(metrics.items())]
+        histograms = []
+        for (name, label_key), values in sorted(
+                snapshot['histograms'].items()):
+            histograms.append({
+                'name': name, 'labels': dict(label_key),
+                'buckets': dict(zip(
+                    [str(b) for b in snapshot['buckets'][name]] + ['+Inf'],
+                    values[:-2])),
+                'sum': values[-2], 'count': values[-1]})
+        return json.dumps({
+            'time': time.time(),
+            'counters': entries(snapshot['counters']),
+            'gauges': entries(snapshot['gauges']),
+            'histograms': histograms,
+            }, indent=1)
+
+    def write(self, path):
+        """Write metrics to path (JSON if it ends with .json)."""
+        path = Path(path)
+        if path.suffix == '.json':
+            content = self.to_json()
+        else:
+            content = self.to_prometheus()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+class SharedCounter:
+    """Counter in shared memory, updated by all worker processes.
+
+    Used for the number of received bytes, so that the throughput of
+    running downloads can be shown (and not only of finished ones).
+
+    """
+    def __init__(self):
+        self._lock = multiprocessing.Lock()
+        self._value = multiprocessing.RawValue('d', 0)
+
+    def add(self, value):
+        with self._lock:
+            self._value.value += value
+
+    @property
+    def value(self):
+        return self._value.value
+
+
+_METRICS = Metrics()
+_bytes_counter = None
+
+
+def get_metrics():
+    """Return the metrics registry of this process."""
+    return _METRICS
+
+
+def reset_metrics():
+    global _METRICS
+    _METRICS = Metrics()
+
+
+def set_bytes_counter(counter):
+    """Set the SharedCounter of received bytes (e.g. in a worker)."""
+    global _bytes_counter
+    _bytes_counter = counter
+
+
+def add_received_bytes(n_bytes):
+    if _bytes_counter is not None:
+        _bytes_counter.add(n_bytes)
+
+
+def record_transfer(host, n_bytes, duration, error=None):
+    """Record a finished download attempt of a single file."""
+    metrics = get_metrics()
+    metrics.inc('transfers_total', host=host, status=error or 'ok')
+    metrics.inc('received_bytes_total', n_bytes, host=host)
+    metrics.observe('file_download_seconds', duration, host=host)
+    if error is None and duration > 0:
+        metrics.observe(
+            'file_throughput_bytes_per_second', n_bytes / duration,
+            buckets=THROUGHPUT_BUCKETS, host=host)
+
+
+class MetricsReporter:
+    """Periodically print a summary line and write the metrics file.
+
+    Runs in a background thread of the main process.
+
+    Args:
+        interval (float): Seconds between two reports.
+        path (str or pathlib.Path): Metrics file (Prometheus text
+            format, or JSON if it ends with .json). If None, only the
+            summary line is printed.
+        status_func (callable): Returns a dict of gauges (e.g.
+            files_done, files_found, queue_depth, remaining_bytes)
+            which are set before every report.
+        bytes_counter (SharedCounter): Received bytes of all processes.
+
+    """
+    def __init__(self, interval, path=None, status_func=None,
+                 bytes_counter=None):
+        self.interval = interval
+        self.path = path
+        self.status_func = status_func
+        self.bytes_counter = bytes_counter
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._t0 = time.monotonic()
+        self._last = (self._t0, 0)
+        self._rate = None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.report()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                logger.warning(f'Could not report metrics ({e!r}).')
+
+    def report(self):
+        metrics = get_metrics()
+        now = time.monotonic()
+        received = self.bytes_counter.value if self.bytes_counter else 0
+        last_time, last_received = self._last
+        if now > last_time:
+            rate = (received - last_received) / (now - last_time)
+            self._rate = rate if self._rate is None else \
+                0.5 * self._rate + 0.5 * rate
+        self._last = now, received
+        status = self.status_func() if self.status_func else {}
+        for name, value in status.items():
+            metrics.set(name, value)
+        metrics.set('received_bytes', received)
+        metrics.set('bytes_per_second', self._rate or 0)
+        eta = None
+        remaining = status.get('remaining_bytes')
+        if remaining is not None and self._rate:
+            eta = remaining / self._rate
+            metrics.set('eta_seconds', eta)
+        if self.path is not None:
+            metrics.write(self.path)
+        print(self.summary_line(status, received, eta))
+
+    def summary_line(self, status, received, eta):
+        elapsed = time.monotonic() - self._t0
+        parts = [f'[{elapsed/3600:.1f}h]']
+        if 'files_found' in status:
+            parts.append(
+                f'{status.get("files_done", 0)}/{status["files_found"]} '
+                f'files ({status.get("files_failed", 0)} failed)')
+        if 'queue_depth' in status:
+            parts.append(
+                f'{status.get("running", 0)} running, '
+                f'{status["queue_depth"]} queued')
+        parts.append(
+            f'{received/1024**3:.2f} GB at '
+            f'{(self._rate or 0)/1024**2:.2f} MB/s')
+        hosts = {}
+        for (name, label_key), value in \
+                get_metrics().snapshot()['counters'].items():
+            if name == 'received_bytes_total':
+                host = dict(label_key).get('host')
+                hosts[host] = hosts.get(host, 0) + value
+        if hosts:
+            top = sorted(hosts.items(), key=lambda h: -h[1])[:3]
+            parts.append('top hosts: ' + ', '.join(
+                f'{h} {v/1024**3:.2f} GB' for h, v in top))
+        if eta is not None:
+            parts.append(f'ETA {eta/3600:.1f}h')
+        return 'Progress: ' + ' | '.join(parts)
@@ -1,57 +1,157 @@
 import dataclasses
 from pathlib import Path
+import sqlite3
+import time
 
 import numpy as np
 import pandas as pd
 
-from cmip6download import helper 
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
 
 
 COL_NAMES = (
-    ['download_date'] + helper.METADATA_FILENAME_LIST + 
+    ['download_date'] + helper.METADATA_FILENAME_LIST +
     ['filename', 'query_file', 'cmip6_api_search_call'])
 
+STORE_FILENAME = 'progress.sqlite'
+SQLITE_TIMEOUT_TIME = 60
+# Facets for which the progress log is indexed
+INDEXED_FACETS = ['variable_id', 'source_id', 'experiment_id', 'member_id']
 
-def log_download_progress(config, data_items):
+
+class ProgressStore:
+    """Append-only log of the download progress.
+
+    Every finished data item is appended as a row to the table
+    progress_log of a sqlite database in the progress logging
+    directory, so that the progress is recorded even if a run is
+    interrupted. The view progress has the columns COL_NAMES and
+    contains the most relevant row of every file (the one with the
+    latest download_date; rows without download_date only if a file
+    was never downloaded).
+
+    When the store is created, existing per-variable CSV files of the
+    progress logging directory are imported.
+
+    Args:
+        directory (str or pathlib.Path): Progress logging directory.
+
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory).absolute()
+        self.path = self.directory / STORE_FILENAME
+        self.directory.mkdir(parents=True, exist_ok=True)
+        new_store = not self.path.exists()
+        self.connection = sqlite3.connect(
+            self.path, timeout=SQLITE_TIMEOUT_TIME)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        columns = ', '.join(f'{col} TEXT' for col in COL_NAMES)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS progress_log ('
+                f'id INTEGER PRIMARY KEY, logged REAL, {columns}, '
+                'verified INTEGER)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS progress_log_filename '
+                'ON progress_log (filename, id)')
+            for facet in INDEXED_FACETS:
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS progress_log_{facet} '
+                    f'ON progress_log ({facet})')
+            self.connection.execute(
+                f'CREATE VIEW IF NOT EXISTS progress AS SELECT '
+                f'{", ".join(COL_NAMES)} FROM progress_log AS p '
+                'WHERE id = (SELECT id FROM progress_log '
+                'WHERE filename = p.filename ORDER BY '
+                'download_date IS NULL, download_date DESC, id DESC '
+                'LIMIT 1)')
+        if new_store:
+            self.import_csv_files()
+
+    def _get_row(self, data_item, verified=None):
+        metadata = data_item.metadata.as_dict()
+        fields = dataclasses.asdict(data_item)
+        row = [time.time()]
+        for col in COL_NAMES:
+            value = metadata.get(col, fields.get(col))
+            row.append(None if value is None else str(value))
+        row.append(None if verified is None else int(verified))
+        return row
+
+    def record(self, data_item, verified=None):
+        """Append the current state of data_item to the log."""
+        self.record_many([data_item], [verified])
+
+    def record_many(self, data_items, verified=None):
+        if verified is None:
+            verified = [None] * len(data_items)
+        rows = [self._get_row(di, v) for di, v in zip(data_items, verified)]
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT INTO progress_log (logged, {", ".join(COL_NAMES)}, '
+                f'verified) VALUES ({", ".join("?" * (len(COL_NAMES)+2))})',
+                rows)
+
+    def query(self, **facets):
+        """Return the progress (view) of files with the given facets.
+
+        Example:
+            >>> store.query(variable_id='tas', experiment_id='historical')
+
+        """
+        for facet in facets:
+            if facet not in COL_NAMES:
+                raise ValueError(f'Unknown column {facet}.')
+        where = ' AND '.join(f'{facet} = ?' for facet in facets)
+        return pd.read_sql_query(
+            'SELECT * FROM progress' + (f' WHERE {where}' if where else ''),
+            self.connection, params=list(facets.values()))
+
+    def import_csv_files(self):
+        """Import the per-variable CSV files of older versions."""
+        for f in sorted(self.directory.glob('*.csv')):
+            try:
+                df = pd.read_csv(f, header=0, dtype=str)
+            except (ValueError, pd.errors.ParserError) as e:
+                logger.warning(f'Could not import progress log {f} ({e}).')
+                continue
+            df = df.reindex(columns=COL_NAMES)
+            df = df.astype(object).where(df.notna(), None)
+            df.insert(0, 'logged', f.stat().st_mtime)
+            df['verified'] = None
+            with self.connection:
+                self.connection.executemany(
+                    f'INSERT INTO progress_log (logged, '
+                    f'{", ".join(COL_NAMES)}, verified) VALUES '
+                    f'({", ".join("?" * (len(COL_NAMES)+2))})',
+                    df.itertuples(index=False, name=None))
+            logger.info(f'Imported {len(df)} rows of progress log {f}.')
+
+    def export_csv_files(self):
+        """Write the progress of every variable to <variable>.csv."""
+        variables = [
+            var for var, in self.connection.execute(
+                'SELECT DISTINCT variable_id FROM progress_log')]
+        for var in variables:
+            df = self.query(variable_id=var).sort_values(
+                'download_date', na_position='first')
+            df.to_csv(self.directory / f'{var}.csv', index=False)
+
+
+def get_progress_store(config):
     if not hasattr(config, 'progress_logging_directory'):
         raise AttributeError(
             'Configuration file must contain a '
             '"progress_logging_directory" entry')
-    data_items_dict = {}
-    for di in data_items:
-        var = di.metadata['variable_id']
-        try:
-            data_items_dict[var].append(di)
-        except KeyError:
-            data_items_dict[var] = [di]
-
-    for var, dis in data_items_dict.items():
-        df_new = _get_df_from_dataitems(data_items)
-        f = Path(config.progress_logging_directory).absolute() / f'{var}.csv'
-        f.parent.mkdir(parents=True, exist_ok=True)
-        try:
-            df_old = pd.read_csv(f, header=0)
-            df = pd.concat([df_old, df_new])
-            df = df.sort_values(
-                'download_date', na_position='first')
-            df = df.drop_duplicates(
-                subset='filename', keep='last')
-        except FileNotFoundError:
-            df = df_new
-        df.to_csv(f, index=False)
-
-
-def _get_df_from_dataitems(data_items):
-    data = {col: [] for col in COL_NAMES}
-    for data_item in data_items:
-        metadata = helper.get_metadata_from_filename(data_item.filename)
-        metadata2 = dataclasses.asdict(data_item)
-        for col in COL_NAMES:
-            if col in metadata.keys():
-                data[col].append(metadata[col])
-            elif col in metadata2.keys():
-                data[col].append(metadata2[col])
-            else:
-                data[col].append(None)
-    df = pd.DataFrame(data, columns=COL_NAMES)
-    return df
+    return ProgressStore(config.progress_logging_directory)
+
+
+def log_download_progress(config, data_items):
+    """Record data_items and export the progress per variable as CSV."""
+    store = get_progress_store(config)
+    store.record_many(data_items)
+    store.export_csv_files()
@@ -0,0 +1,174 @@
+from dataclasses import dataclass, fields, replace
+import itertools
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+# Facets which can be recovered from the filename of a search result
+# (query facet -> field of helper.FilenameMetadata). Only
+# queries differing in these facets are merged into one request,
+# because only for them the results can be split up again.
+SPLITTABLE_FACETS = {
+    'variable': 'variable_id',
+    'experiment_id': 'experiment_id',
+    'source_id': 'source_id',
+    'member_id': 'member_id',
+    'grid_label': 'grid_label',
+}
+
+
+@dataclass
+class QueryPlan:
+    """Search requests which answer a list of queries.
+
+    Attrs:
+        requests (list[tuple[BaseAPIQuery, list[BaseAPIQuery]]]): Every
+            request (whose facets may be multi-valued, i.e. tuples)
+            together with the (normalised) queries it answers.
+        n_queries (int): Number of queries the plan was made for
+            (including duplicates).
+
+    """
+    requests: list
+    n_queries: int
+
+    @property
+    def queries(self):
+        return [q for _, queries in self.requests for q in queries]
+
+    @property
+    def n_saved(self):
+        return self.n_queries - len(self.requests)
+
+    def __str__(self):
+        return (f'Query plan: {self.n_queries} queries are answered by '
+                f'{len(self.requests)} search requests ({self.n_saved} '
+                'API calls saved).')
+
+
+def _as_tuple(value):
+    if isinstance(value, tuple):
+        return value
+    return (value,)
+
+
+def _normalize_value(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (list, tuple, set)):
+        values = tuple(sorted({_normalize_value(v) for v in value}))
+        return values[0] if len(values) == 1 else values
+    return value
+
+
+def normalize_query(query):
+    """Return query with stripped strings and lowercase booleans."""
+    return replace(query, **{
+        f.name: _normalize_value(getattr(query, f.name))
+        for f in fields(query) if f.name != 'priority'})
+
+
+def _get_superset_key(key, keys):
+    """Return the largest key in keys which contains all results of key.
+
+    A key contains the results of another one if it only differs in
+    splittable facets which it does not restrict (i.e. which are None).
+
+    """
+    facets = [f for f in SPLITTABLE_FACETS if getattr(key, f) is not None]
+    for n in range(len(facets), 0, -1):
+        for n_facets in itertools.combinations(facets, n):
+            superset_key = replace(key, **{f: None for f in n_facets})
+            if superset_key in keys:
+                return superset_key
+    return None
+
+
+def _merge_keys(request_queries, facet):
+    """Merge keys which only differ in the value of facet."""
+    groups = {}
+    for key in request_queries:
+        if getattr(key, facet) is None:
+            groups[(key,)] = [key]
+        else:
+            groups.setdefault(replace(key, **{facet: None}), []).append(key)
+    merged_request_queries = {}
+    for group in groups.values():
+        if len(group) == 1:
+            merged_request_queries[group[0]] = request_queries[group[0]]
+            continue
+        values = tuple(sorted({
+            v for key in group for v in _as_tuple(getattr(key, facet))}))
+        merged_key = replace(group[0], **{facet: values})
+        merged_request_queries[merged_key] = [
+            q for key in group for q in request_queries[key]]
+    return merged_request_queries
+
+
+def plan_queries(queries):
+    """Return the QueryPlan with the fewest requests for queries.
+
+    1) Queries are normalised and exact duplicates removed.
+    2) Queries whose results are contained in the results of another
+       query (e.g. of the same query with member_id None) are answered
+       by the latter.
+    3) Requests which differ in a single splittable facet are merged
+       into one request with multiple values of this facet. This is
+       repeated (for all facets) as long as requests can be merged.
+
+    Priorities do not influence the requests, so queries only differing
+    in their priority are answered by the same request.
+
+    """
+    n_queries = len(queries)
+    queries = list(dict.fromkeys(normalize_query(q) for q in queries))
+
+    # Queries are grouped by their key, i.e. the query without priority.
+    key_queries = {}
+    for query in queries:
+        key_queries.setdefault(replace(query, priority=None), []).append(query)
+
+    request_queries = {}
+    superset_keys = {}
+    for key in key_queries:
+        superset_key = _get_superset_key(key, key_queries)
+        if superset_key is None:
+            request_queries[key] = list(key_queries[key])
+        else:
+            superset_keys[key] = superset_key
+    for key, superset_key in superset_keys.items():
+        request_queries[superset_key].extend(key_queries[key])
+
+    n_requests = None
+    while n_requests != len(request_queries):
+        n_requests = len(request_queries)
+        for facet in SPLITTABLE_FACETS:
+            request_queries = _merge_keys(request_queries, facet)
+
+    requests = [
+        (replace(key, priority=max(q.priority for q in queries)), queries)
+        for key, queries in request_queries.items()]
+    return QueryPlan(requests=requests, n_queries=n_queries)
+
+
+def split_data_items(data_items, request, query):
+    """Return the data items of the results of request matching query."""
+    facets = {
+        facet: _as_tuple(getattr(query, facet))
+        for facet in SPLITTABLE_FACETS
+        if getattr(query, facet) is not None
+        and getattr(query, facet) != getattr(request, facet)}
+    if not facets:
+        return list(data_items)
+    query_data_items = []
+    for data_item in data_items:
+        metadata = data_item.metadata
+        if all(getattr(metadata, SPLITTABLE_FACETS[facet]) in values
+               for facet, values in facets.items()):
+            query_data_items.append(data_item)
+    return query_data_items
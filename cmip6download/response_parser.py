@@ -0,0 +1,136 @@
+import io
+import json
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+class BaseResponseParser:
+    """Base class for parsing responses of the search API.
+
+    A parser turns the raw content of an API response into the total
+    number of results (numFound) and a list of documents. Every
+    document is a dict mapping Solr field names to their values, where
+    multi-valued fields (`arr` tags) are lists, e.g.:
+
+        {'title': 'areacello_Ofx_..._gn.nc', 'checksum': ['4e2f...'],
+         'checksum_type': ['SHA256'], 'url': ['http://...|...|HTTPServer']}
+
+    Attributes:
+        name (str): Name used to select the parser in the config.
+        response_format (str): Value of the `format` API parameter
+            required by this parser (None for the default XML response).
+
+    """
+    name = None
+    response_format = None
+
+    def parse(self, content):
+        """Return (numFound, documents) of the response content (bytes)."""
+        raise NotImplementedError
+
+
+class SolrJSONResponseParser(BaseResponseParser):
+    """Decode responses requested with format=application/solr+json."""
+    name = 'json'
+    response_format = 'application/solr+json'
+
+    def parse(self, content):
+        response = json.loads(content)['response']
+        return int(response['numFound']), response['docs']
+
+
+class LxmlResponseParser(BaseResponseParser):
+    """Stream XML responses with lxml.etree.iterparse.
+
+    Every `doc` element is converted to a dict as soon as it has been
+    parsed and is cleared afterwards, so the whole tree is never
+    kept in memory.
+
+    """
+    name = 'lxml'
+
+    def parse(self, content):
+        num_found = 0
+        docs = []
+        for event, elem in etree.iterparse(
+                io.BytesIO(content), events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'result':
+                    num_found = int(elem.get('numFound', 0))
+                continue
+            if elem.tag != 'doc':
+                continue
+            doc = {}
+            for field in elem:
+                if field.tag == 'arr':
+                    doc[field.get('name')] = [v.text for v in field]
+                else:
+                    doc[field.get('name')] = field.text
+            docs.append(doc)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return num_found, docs
+
+
+class BeautifulSoupResponseParser(BaseResponseParser):
+    """Parse XML responses with BeautifulSoup (slow but lenient)."""
+    name = 'bs4'
+
+    def parse(self, content):
+        result_tag = BeautifulSoup(content, 'lxml').result
+        num_found = int(result_tag.get('numfound', 0))
+        docs = []
+        for doc_tag in result_tag.find_all('doc'):
+            doc = {}
+            for field in doc_tag.find_all(recursive=False):
+                if field.name == 'arr':
+                    doc[field['name']] = [
+                        str(v.string) for v in field.find_all('str')]
+                else:
+                    doc[field['name']] = str(field.string)
+            docs.append(doc)
+        return num_found, docs
+
+
+RESPONSE_PARSERS = {
+    parser.name: parser for parser in [
+        SolrJSONResponseParser, LxmlResponseParser,
+        BeautifulSoupResponseParser]
+    }
+
+
+def get_response_parser(name):
+    """Return parser instance with the given name."""
+    try:
+        return RESPONSE_PARSERS[name]()
+    except KeyError:
+        raise ValueError(
+            f'Unknown search response parser {name} (available: '
+            f'{", ".join(RESPONSE_PARSERS)}).')
+
+
+def parse_response(parser, content):
+    """Parse content with parser and fall back to BeautifulSoup.
+
+    If a XML response cannot be parsed by the given parser (e.g.
+    because it is not well-formed) the more lenient
+    BeautifulSoupResponseParser is used instead.
+
+    """
+    try:
+        return parser.parse(content)
+    except (ValueError, KeyError, etree.XMLSyntaxError) as e:
+        if parser.response_format is not None or \
+                isinstance(parser, BeautifulSoupResponseParser):
+            raise
+        logger.warning(
+            f'{parser.name} could not parse the response ({e}), '
+            'fall back to BeautifulSoup.')
+        return BeautifulSoupResponseParser().parse(content)
@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+import random
+import time
+
+
+# Errors after which the same replica may succeed (after a while)
+RETRYABLE_ERRORS = (
+    'timeout', 'connection', 'server_error', 'rate_limited', 'incomplete',
+    'checksum')
+# Errors after which the replica is not tried again (e.g. 404)
+FATAL_ERRORS = ('not_found', 'http_error')
+
+
+def classify_status_code(status_code):
+    """Return the error category of a HTTP error status code."""
+    if status_code in (404, 410):
+        return 'not_found'
+    if status_code == 429:
+        return 'rate_limited'
+    if status_code >= 500:
+        return 'server_error'
+    return 'http_error'
+
+
+@dataclass
+class RetryPolicy:
+    """How often and how fast failed downloads are retried.
+
+    Attributes:
+        max_attempts (int): Total number of attempts of a file, over
+            all of its replicas.
+        backoff_base (float): Delay (s) before the second attempt on
+            the same replica. It doubles with every further failure of
+            this replica.
+        backoff_max (float): Upper bound of the delay (s).
+
+    """
+    max_attempts: int = 1
+    backoff_base: float = 1
+    backoff_max: float = 60
+
+    def get_delay(self, n_failures):
+        """Return the delay before retrying a replica which failed
+        n_failures times (exponential backoff with full jitter)."""
+        if n_failures == 0:
+            return 0
+        return random.uniform(0, min(
+            self.backoff_max, self.backoff_base * 2**(n_failures-1)))
+
+
+class ReplicaRotation:
+    """Attempts of a single download, rotating through its replicas.
+
+    Every attempt uses the next replica in turn (starting with the
+    first, i.e. best, URL), so that a failing replica is not hit again
+    before all others were tried. A replica is only retried after the
+    backoff delay of its previous failures. Replicas which failed with
+    a fatal error are skipped; if all replicas failed fatally, the
+    download is given up before max_attempts is reached.
+
+    The retry times are wall-clock times, so that a rotation can be
+    passed to another process which continues the download (see
+    defer).
+
+    Example:
+        >>> rotation = ReplicaRotation(urls, policy)
+        >>> for url, delay in iter(rotation.next, None):
+        ...     time.sleep(delay)
+        ...     error = download(url)
+        ...     if error is None:
+        ...         break
+        ...     rotation.record_failure(url, error)
+
+    Args:
+        urls (list[str]): URLs of all replicas, best first.
+        policy (RetryPolicy): Retry policy.
+
+    """
+    def __init__(self, urls, policy):
+        # Replicas merged from several search results may repeat
+        self.urls = list(dict.fromkeys(urls))
+        self.policy = policy
+        self.n_attempts = 0
+        self.failures = {url: 0 for url in self.urls}
+        # Time (time.time()) after which a replica may be retried
+        self.not_before = {}
+        self.fatal = set()
+        self._next_index = 0
+
+    @property
+    def exhausted(self):
+        """True if no further attempt is allowed."""
+        return self.n_attempts >= self.policy.max_attempts or \
+            len(self.fatal) == len(self.urls)
+
+    def next(self):
+        """Return (url, delay) of the next attempt or None."""
+        if self.exhausted:
+            return None
+        for _ in range(len(self.urls)):
+            url = self.urls[self._next_index % len(self.urls)]
+            self._next_index += 1
+            if url not in self.fatal:
+                self.n_attempts += 1
+                delay = self.not_before.get(url, 0) - time.time()
+                return url, max(0, delay)
+        return None
+
+    def defer(self):
+        """Undo the last call of next(), e.g. to wait for its delay
+        outside of this process. The next call returns the same url."""
+        self.n_attempts -= 1
+        self._next_index -= 1
+
+    def record_failure(self, url, error):
+        """Record that the attempt on url failed with error category."""
+        self.failures[url] += 1
+        self.not_before[url] = time.time() + self.policy.get_delay(
+            self.failures[url])
+        if error in FATAL_ERRORS:
+            self.fatal.add(url)
@@ -0,0 +1,224 @@
+from dataclasses import dataclass
+import functools
+import heapq
+import itertools
+from multiprocessing import Pool
+import queue
+import time
+
+from cmip6download import helper
+from cmip6download import host_health
+
+
+logger = helper.get_logger(__file__)
+
+
+@dataclass
+class DownloadResult:
+    """Outcome of downloading a single data item in a worker.
+
+    Only this small record is sent back from the worker processes
+    (instead of the whole data item).
+
+    """
+    index: int
+    filename: str
+    verified: bool
+    download_date: str = None
+    used_download_urls: list = None
+    # (host, n_bytes, duration, error) of every download attempt
+    transfers: list = None
+    # Snapshot of the metrics of the worker (see metrics.Metrics)
+    metrics: dict = None
+    # Observations of the host health table of the worker (see
+    # host_health.HostHealthTable.pop_journal)
+    host_health: list = None
+    # Set if the download was deferred (see BaseDataItem.download):
+    # delay (s) and host of its next attempt and its replica rotation
+    retry_after: float = None
+    retry_host: str = None
+    rotation: object = None
+
+
+class DownloadScheduler:
+    """Long-lived scheduler for the downloads of all queries.
+
+    Jobs of all queries are put into a single queue ordered by
+    priority (highest first; jobs with equal priority keep their
+    insertion order). A single process pool is used for the whole run
+    and is kept busy: as soon as a job finishes, the next job is
+    submitted.
+
+    Every job can be given the hosts of its replicas. If a per-host
+    limit applies (max_downloads_per_host or controller), a job is
+    only started if one of its hosts has free capacity; the healthy
+    host with the fewest running jobs is chosen and passed to func as
+    keyword argument host. func must only download from this host,
+    since the running jobs are counted by host. Jobs whose hosts are
+    all busy are skipped in favour of lower priority jobs on other
+    hosts. Without per-host limits, host is None and func may download
+    from any of its replicas.
+
+    Jobs can be added while the scheduler runs, e.g. to retry a failed
+    download. A job with not_before is only started after this time,
+    without occupying a worker while it waits.
+
+    Args:
+        n_worker (int): Number of worker processes (parallel jobs).
+        func (callable): Function which is called in the workers with
+            the arguments of every job.
+        max_downloads_per_host (int): Maximum number of jobs running
+            in parallel on a single host (None for no limit).
+        controller (concurrency.AdaptiveConcurrencyController): If
+            given, the number of running jobs (at most n_worker) and
+            the per-host limits are adapted by this controller.
+        initializer (callable): Called at the start of every worker.
+        initargs (tuple): Arguments of initializer.
+
+    """
+    def __init__(
+            self, n_worker, func, max_downloads_per_host=None,
+            controller=None, initializer=None, initargs=()):
+        self.n_worker = n_worker
+        self.func = func
+        self.max_downloads_per_host = max_downloads_per_host
+        self.controller = controller
+        self.initializer = initializer
+        self.initargs = initargs
+        # Jobs are grouped by the set of their hosts, every group is a
+        # heap ordered by (-priority, insertion counter).
+        self._job_groups = {}
+        # Heap of (not_before, counter, priority, args, hosts)
+        self._delayed_jobs = []
+        self._n_jobs = 0
+        self._counter = itertools.count()
+        self._host_running = {}
+        self.n_running = 0
+
+    def __len__(self):
+        return self._n_jobs
+
+    def add(self, priority, *args, hosts=None, not_before=None):
+        """Add a job calling func(*args) with the given priority.
+
+        Args:
+            hosts (list[str]): Hosts from which the job can download.
+            not_before (float): Earliest start (time.monotonic()).
+
+        """
+        if not_before is not None and not_before > time.monotonic():
+            heapq.heappush(self._delayed_jobs, (
+                not_before, next(self._counter), priority, args, hosts))
+        else:
+            jobs = self._job_groups.setdefault(frozenset(hosts or []), [])
+            heapq.heappush(jobs, (-priority, next(self._counter), args))
+        self._n_jobs += 1
+
+    def _release_delayed_jobs(self):
+        """Move the delayed jobs whose time has come into the queue and
+        return the time (s) until the next one (or None)."""
+        now = time.monotonic()
+        while self._delayed_jobs and self._delayed_jobs[0][0] <= now:
+            _, _, priority, args, hosts = heapq.heappop(self._delayed_jobs)
+            self._n_jobs -= 1
+            self.add(priority, *args, hosts=hosts)
+        if self._delayed_jobs:
+            return self._delayed_jobs[0][0] - now
+        return None
+
+    @property
+    def limit(self):
+        """Current maximum number of running jobs."""
+        if self.controller is None:
+            return self.n_worker
+        return min(self.n_worker, self.controller.limit)
+
+    def _get_host_limit(self, host):
+        limits = []
+        if self.max_downloads_per_host is not None:
+            limits.append(max(1, self.max_downloads_per_host))
+        if self.controller is not None:
+            limits.append(max(1, self.controller.get_host_limit(host)))
+        return min(limits) if limits else None
+
+    def _select_host(self, hosts):
+        """Return (runnable, host) for a job with the given hosts."""
+        if not hosts:
+            return True, None
+        free_hosts = []
+        limited = False
+        for host in hosts:
+            host_limit = self._get_host_limit(host)
+            limited |= host_limit is not None
+            if host_limit is None or \
+                    self._host_running.get(host, 0) < host_limit:
+                free_hosts.append(host)
+        if not limited:
+            # Nothing to count, the job may rotate over all replicas
+            return True, None
+        if not free_hosts:
+            return False, None
+        table = host_health.get_host_health_table()
+        return True, min(free_hosts, key=lambda h: (
+            table.is_dead(h), self._host_running.get(h, 0),
+            table.expected_time(h)))
+
+    def _pop_job(self):
+        """Pop the highest priority job that can run now (or None)."""
+        best = None
+        for hosts, jobs in self._job_groups.items():
+            if not jobs or (best is not None and jobs[0][:2] > best[0]):
+                continue
+            runnable, host = self._select_host(hosts)
+            if runnable:
+                best = jobs[0][:2], jobs, host
+        if best is None:
+            return None
+        _, jobs, host = best
+        _, _, args = heapq.heappop(jobs)
+        self._n_jobs -= 1
+        return args, host
+
+    def run(self):
+        """Run all jobs and yield their results as they finish."""
+        finished = queue.Queue()
+        self.n_running = 0
+        with Pool(
+                self.n_worker, initializer=self.initializer,
+                initargs=self.initargs) as p:
+            while self._n_jobs or self.n_running:
+                wait_time = self._release_delayed_jobs()
+                while self.n_running < self.limit:
+                    job = self._pop_job()
+                    if job is None:
+                        break
+                    args, host = job
+                    callback = functools.partial(
+                        self._finish, finished, host)
+                    p.apply_async(
+                        self.func, args, {'host': host}, callback=callback,
+                        error_callback=callback)
+                    self.n_running += 1
+                    if host is not None:
+                        self._host_running[host] = \
+                            self._host_running.get(host, 0) + 1
+                try:
+                    host, result = finished.get(timeout=wait_time)
+                except queue.Empty:
+                    continue
+                self.n_running -= 1
+                if host is not None:
+                    self._host_running[host] -= 1
+                if isinstance(result, BaseException):
+                    logger.error(f'Download job failed: {result!r}')
+                    continue
+                if self.controller is not None:
+                    self.controller.record(result)
+                yield result
+            # Let the workers exit normally (e.g. to dump profiles)
+            p.close()
+            p.join()
+
+    @staticmethod
+    def _finish(finished, host, result):
+        finished.put((host, result))
@@ -0,0 +1,113 @@
+import json
+from pathlib import Path
+import sqlite3
+import threading
+import time
+import zlib
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+CACHE_FILENAME = 'search_cache.sqlite'
+
+
+class SearchCache:
+    """Persistent cache of search results.
+
+    Results are stored in a sqlite database in cache_dir, keyed by the
+    request URL of the query (BaseAPISearcher.get_request_url). Every
+    entry holds the number of results reported by the API (numFound)
+    and the zlib compressed JSON records of the found data items.
+
+    Entries older than ttl are stale: they are only used again if a
+    cheap revalidation (numFound of the same query) still matches.
+    If the total size of all entries exceeds max_size, the least
+    recently used entries are evicted.
+
+    Args:
+        cache_dir (str or pathlib.Path): Directory of the database.
+        ttl (float): Time to live of an entry in seconds.
+        max_size (int): Maximum total size of all entries in bytes.
+        refresh (bool): If True, cached entries are never returned
+            (but still updated).
+
+    """
+    def __init__(self, cache_dir, ttl=86400, max_size=512*1024**2,
+                 refresh=False):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.cache_dir / CACHE_FILENAME, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS search_results ('
+                'url TEXT PRIMARY KEY, num_found INTEGER, '
+                'created REAL, last_access REAL, size INTEGER, data BLOB)')
+
+    def get(self, url):
+        """Return (num_found, records, stale) for url or None.
+
+        stale is True if the entry is older than the ttl.
+
+        """
+        if self.refresh:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT num_found, created, data FROM search_results '
+                'WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE search_results SET last_access = ? '
+                    'WHERE url = ?', (time.time(), url))
+        num_found, created, data = row
+        records = json.loads(zlib.decompress(data))
+        stale = time.time() - created > self.ttl
+        return num_found, records, stale
+
+    def set(self, url, num_found, records):
+        """Store the records of url and evict old entries if needed."""
+        data = zlib.compress(json.dumps(records).encode())
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO search_results '
+                '(url, num_found, created, last_access, size, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (url, num_found, now, now, len(data), data))
+            self._evict()
+
+    def touch(self, url):
+        """Mark the entry of url as fresh (after a revalidation)."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE search_results SET created = ? WHERE url = ?',
+                (time.time(), url))
+
+    def _evict(self):
+        total_size = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM search_results'
+            ).fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        rows = self._connection.execute(
+            'SELECT url, size FROM search_results '
+            'ORDER BY last_access ASC').fetchall()
+        evict_urls = []
+        for url, size in rows:
+            if total_size <= self.max_size:
+                break
+            evict_urls.append((url,))
+            total_size -= size
+        self._connection.executemany(
+            'DELETE FROM search_results WHERE url = ?', evict_urls)
+        logger.debug(f'Evicted {len(evict_urls)} search cache entries.')
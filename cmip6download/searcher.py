@@ -1,15 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+import threading
+import time
 import urllib
 
 import requests
-from bs4 import BeautifulSoup
 
 from cmip6download import helper
+from cmip6download import http_session
+from cmip6download import metrics
+from cmip6download import query_planner
 from cmip6download.data_item import CMIP6DataItem
+from cmip6download import response_parser
+from cmip6download import retry
+from cmip6download import tracing
 
 
 logger = helper.get_logger(__file__)
 
 HTTP_BASE_TIMEOUT_TIME = 240
+# Delay (s) before the second attempt of a result page, doubled with
+# every further attempt (see retry.RetryPolicy)
+SEARCH_BACKOFF_BASE = 1
+SEARCH_BACKOFF_MAX = 30
 
 
 class BaseAPISearcher:
@@ -22,19 +35,32 @@ class BaseAPISearcher:
     def __init__(self, base_api_url):
         self.base_api_url = base_api_url
 
-    def get_request_url(self, query):
+    def get_request_url(
+            self, query, offset=None, limit=None, response_format=None):
         """Return search URL based on a search query.
 
         Args:
             query (BaseAPIQuery): Paramters set of this
                 instance are used in the API calls.
+            offset (int): Index of the first result which is returned
+                (used for paginated requests).
+            limit (int): Overwrites the limit of the query.
+            response_format (str): Requested format of the response
+                (e.g. application/solr+json).
 
         """
         query_dict = {
             key: value for key, value in query.as_query_dict().items()
             if value is not None}
+        if offset is not None:
+            query_dict['offset'] = offset
+        if limit is not None:
+            query_dict['limit'] = limit
+        if response_format is not None:
+            query_dict['format'] = response_format
         urlparts = list(urllib.parse.urlparse(self.base_api_url))
-        urlparts[4] = urllib.parse.urlencode(query_dict)
+        # Multi-valued facets (tuples) are sent as repeated parameters.
+        urlparts[4] = urllib.parse.urlencode(query_dict, doseq=True)
         url = urllib.parse.urlunparse(urlparts)
         return url
 
@@ -54,11 +80,33 @@ class CMIP6APISearcher(BaseAPISearcher):
         base_api_url (str): Base URL for the CMIP6 search API.
         base_data_dir (str or pathlib.Path): Base path where
             downloaded data should be stored.
+        n_search_workers (int): Number of parallel API calls (over all
+            queries and their result pages).
+        search_page_size (int): Number of results which are requested
+            per API call. If None, the limit of the query is used.
+        max_search_attempts (int): Number of attempts per API call
+            before the corresponding result page is given up.
+        search_response_parser (str): Name of the parser used for API
+            responses (see response_parser.RESPONSE_PARSERS).
+        search_cache (search_cache.SearchCache): If given, search results
+            are looked up in and stored to this cache.
 
     """
-    def __init__(self, base_api_url, base_data_dir):
+    def __init__(
+            self, base_api_url, base_data_dir, n_search_workers=1,
+            search_page_size=None, max_search_attempts=1,
+            search_response_parser='json', search_cache=None):
         super().__init__(base_api_url)
         self.base_data_dir = base_data_dir
+        self.n_search_workers = max(1, n_search_workers)
+        # Shared by all threads which request result pages
+        self._request_slots = threading.BoundedSemaphore(
+            self.n_search_workers)
+        self.search_page_size = search_page_size
+        self.max_search_attempts = max(1, max_search_attempts)
+        self.response_parser = response_parser.get_response_parser(
+            search_response_parser)
+        self.search_cache = search_cache
 
     def get_data_items(self, query, filter_kwargs=None):
         """
@@ -74,9 +122,14 @@ class CMIP6APISearcher(BaseAPISearcher):
                 for every file that can be downloaded.
 
         """
+        return self._get_query_data_items(
+            self.get_result_data_items(query), query,
+            filter_kwargs=filter_kwargs)
+
+    def _get_query_data_items(self, data_items, query, filter_kwargs=None):
+        """Filter raw data items of query and combine their replicas."""
         if filter_kwargs is None:
             filter_kwargs = {}
-        data_items = self.get_result_data_items(query)
         n_data_items0 = len(data_items)
         data_items = self._filter_data_items(data_items, query, **filter_kwargs)
 
@@ -101,45 +154,209 @@ class CMIP6APISearcher(BaseAPISearcher):
             f'{len(replica_combined_data_items)} data files found.')
         return replica_combined_data_items
 
+    def get_data_items_concurrently(
+            self, queries, filter_kwargs=None, n_search_workers=None):
+        """
+        Search for CMIP6 data of several queries in parallel.
+
+        The queries are first combined into as few search requests as
+        possible (see query_planner.plan_queries). All requests are then
+        issued at once (limited by n_search_workers) so that the total
+        search time is bounded by the slowest request and not by the sum
+        of all of them. Finally, the results of every request are split
+        up into the results of its queries.
+
+        Attrs:
+            queries (list[CMIP6Query]): Queries which are searched for.
+            filter_kwargs (dict): Passed on to get_data_items.
+            n_search_workers (int): Number of requests which are
+                searched at once. If None, the n_search_workers of the
+                searcher is used. The API calls of all their pages are
+                limited to the n_search_workers of the searcher.
+
+        Returns:
+            results (list[tuple[CMIP6Query, list[CMIP6DataItem]]]): Found
+                data items of every (normalised and unique) query,
+                ordered by query priority (highest priority first).
+
+        """
+        if n_search_workers is None:
+            n_search_workers = self.n_search_workers
+        plan = query_planner.plan_queries(queries)
+        logger.info(plan)
+        search_requests = [request for request, _ in plan.requests]
+        with ThreadPoolExecutor(max_workers=max(1, n_search_workers)) as ex:
+            request_results = list(ex.map(
+                self.get_result_data_items, search_requests))
+
+        results = {}
+        for (request, request_queries), data_items in zip(
+                plan.requests, request_results):
+            for query in request_queries:
+                query_data_items = query_planner.split_data_items(
+                    data_items, request, query)
+                if len(request_queries) > 1:
+                    # Replicas are combined in place, so every query
+                    # needs its own copies of shared data items.
+                    query_data_items = [
+                        dataclasses.replace(di, file_urls=list(di.file_urls))
+                        for di in query_data_items]
+                results[query] = self._get_query_data_items(
+                    query_data_items, query, filter_kwargs=filter_kwargs)
+        queries = list(reversed(sorted(plan.queries)))
+        return [(query, results[query]) for query in queries]
+
     def get_result_data_items(self, query):
         """Return data items directly from an API call using query.
 
-        These data items are a python representation of ALL `result`
-        xml tags in the API response. These "raw" data items are then 
+        These data items are a python representation of ALL `doc`
+        entries in the API response. These "raw" data items are then 
         further filtered/extended/altered.
 
+        If a search cache is set, cached results are returned as long
+        as they are fresh or their number of results did not change.
+
+        """
+        with tracing.span(
+                'search', category='query', query=query.name) as span_args:
+            data_items = self._get_result_data_items(query)
+            span_args['n_results'] = len(data_items)
+        return data_items
+
+    def _get_result_data_items(self, query):
+        url = self.get_request_url(query)
+        if self.search_cache is not None:
+            cached = self.search_cache.get(url)
+            if cached is not None:
+                num_found, records, stale = cached
+                if stale:
+                    revalidation = self._get_result_page(query, 0, 0)
+                    if revalidation is not None and \
+                            revalidation[0] == num_found:
+                        self.search_cache.touch(url)
+                        stale = False
+                if not stale:
+                    metrics.get_metrics().inc('search_cache_hits_total')
+                    logger.debug(
+                        f'Use cached search results for {query.name}.')
+                    return [
+                        self._get_data_item_from_record(r) for r in records]
+
+        num_found, data_items, complete = self._search_result_data_items(
+            query)
+        if self.search_cache is not None and complete:
+            self.search_cache.set(url, num_found, [
+                self._get_record_from_data_item(di) for di in data_items])
+        return data_items
+
+    def _search_result_data_items(self, query):
+        """Return (numFound, data items, complete) of all result pages.
+
+        The results are requested in pages of search_page_size. The
+        first page reveals the total number of results (numFound), all
+        remaining pages are then fetched in parallel. complete is False
+        if any page could not be fetched.
+
+        """
+        page_size = self.search_page_size or query.limit
+        first_page = self._get_result_page(query, 0, page_size)
+        if first_page is None:
+            return 0, [], False
+        num_found, data_items = first_page
+        complete = True
+
+        offsets = list(range(page_size, num_found, page_size))
+        if offsets:
+            logger.debug(
+                f'{num_found} results found, fetch {len(offsets)} '
+                'additional pages.')
+            with ThreadPoolExecutor(
+                    max_workers=self.n_search_workers) as ex:
+                pages = list(ex.map(
+                    lambda o: self._get_result_page(query, o, page_size),
+                    offsets))
+            for offset, page in zip(offsets, pages):
+                if page is None:
+                    last = min(offset+page_size, num_found)
+                    logger.warning(
+                        f'Results {offset}-{last} of {num_found} are '
+                        f'missing for {query.name}.')
+                    complete = False
+                    continue
+                data_items.extend(page[1])
+        return num_found, data_items, complete
+
+    def _get_result_page(self, query, offset, limit):
+        """Return (numFound, data items) of a single page of results.
+
+        Every page is retried on its own up to max_search_attempts
+        times with exponential backoff. If all attempts fail, None is
+        returned. At most n_search_workers pages are requested at once.
+
         """
-        try:
-            url = self.get_request_url(query)
-            print(f'API CALL: {url}')
-            http_request = requests.get(
-                url, timeout=HTTP_BASE_TIMEOUT_TIME,
-                allow_redirects=True, verify=False,
-                )
-        except requests.exceptions.ReadTimeout as e:
-            logger.warning(f'Could not get list of downloadable files ({e}).')
-        except Exception as e:
-            print(
-                f'The following exception was raised while '
-                f'accessing the URL {url}: {e}.')
-            raise
-
-        result_tag = BeautifulSoup(http_request.text, 'lxml').result
-        doc_tags = result_tag.find_all('doc')
-        return [
-            self._get_result_data_item_from_doctag(d) for d in doc_tags]
-
-    def _get_result_data_item_from_doctag(self, doc_tag):
-        filename = str(doc_tag.find('str', attrs={'name': 'title'}).string)
-        remote_checksum = str(doc_tag.find(
-            'arr', attrs={'name': 'checksum'}).str.string)
-        remote_checksum_type = str(doc_tag.find(
-            'arr', attrs={'name': 'checksum_type'}).str.string)
+        url = self.get_request_url(
+            query, offset=offset, limit=limit,
+            response_format=self.response_parser.response_format)
+        policy = retry.RetryPolicy(
+            backoff_base=SEARCH_BACKOFF_BASE, backoff_max=SEARCH_BACKOFF_MAX)
+        for attempt in range(1, self.max_search_attempts+1):
+            time.sleep(policy.get_delay(attempt-1))
+            try:
+                with self._request_slots:
+                    print(f'API CALL: {url}')
+                    t0 = time.monotonic()
+                    with tracing.span(
+                            'search_request', category='query',
+                            query=query.name, offset=offset,
+                            attempt=attempt):
+                        http_request = http_session.get_session().get(
+                            url, timeout=HTTP_BASE_TIMEOUT_TIME,
+                            allow_redirects=True, verify=False,
+                            )
+                        http_request.raise_for_status()
+                t1 = time.monotonic()
+                with tracing.span(
+                        'search_parse', category='query', query=query.name,
+                        parser=self.response_parser.name):
+                    page = self._parse_response(http_request.content)
+                search_metrics = metrics.get_metrics()
+                search_metrics.inc('search_requests_total', status='ok')
+                search_metrics.inc(
+                    'search_response_bytes_total', len(http_request.content))
+                search_metrics.inc('search_results_total', len(page[1]))
+                search_metrics.observe('search_request_seconds', t1 - t0)
+                search_metrics.observe(
+                    'search_parse_seconds', time.monotonic() - t1)
+                return page
+            except requests.exceptions.RequestException as e:
+                metrics.get_metrics().inc(
+                    'search_requests_total', status='error')
+                logger.warning(
+                    f'Could not get list of downloadable files ({e}; '
+                    f'attempt {attempt} of {self.max_search_attempts}).')
+            except Exception as e:
+                print(
+                    f'The following exception was raised while '
+                    f'accessing the URL {url}: {e}.')
+                raise
+        return None
+
+    def _parse_response(self, content):
+        """Return (numFound, data items) of an API response."""
+        num_found, docs = response_parser.parse_response(
+            self.response_parser, content)
+        return num_found, [
+            self._get_result_data_item_from_doc(d) for d in docs]
+
+    def _get_result_data_item_from_doc(self, doc):
+        filename = doc['title']
+        remote_checksum = doc['checksum'][0]
+        remote_checksum_type = doc['checksum_type'][0]
+        size = doc.get('size')
         file_url = None
-        for url_str in doc_tag.find(
-                'arr', attrs={'name': 'url'}).find_all('str'):
+        for url_str in doc['url']:
             tmp_file_url, _, tmp_file_download_type = [
-                    s.strip() for s in url_str.string.split('|')]
+                    s.strip() for s in url_str.split('|')]
             if tmp_file_download_type.lower() == 'httpserver':
                 file_url = tmp_file_url
                 break;
@@ -151,9 +368,20 @@ class CMIP6APISearcher(BaseAPISearcher):
             file_urls=[file_url],
             remote_checksum=remote_checksum,
             remote_checksum_type=remote_checksum_type,
+            size=None if size is None else int(size),
             local_base_dir=self.base_data_dir,
             )
 
+    def _get_record_from_data_item(self, data_item):
+        """Return JSON serializable record of a search result."""
+        return {
+            f.name: getattr(data_item, f.name)
+            for f in dataclasses.fields(data_item)
+            if f.name != 'local_base_dir'}
+
+    def _get_data_item_from_record(self, record):
+        return CMIP6DataItem(local_base_dir=self.base_data_dir, **record)
+
     def _filter_data_items(self, data_items, query, **kwargs):
         """
         Kwargs:
@@ -163,39 +391,30 @@ class CMIP6APISearcher(BaseAPISearcher):
         """
         filtered_data_items = data_items
 
-        unq_models = list({
-            d.metadata['source_id'] for d in data_items
-            })
-
         max_number_of_members = kwargs.get('max_number_of_members', None)
         if max_number_of_members:
-            all_model_data_items = []
-            for model in unq_models:
-                model_data_items = [
-                    d for d in filtered_data_items
-                    if d.metadata['source_id'] == model]
-                unq_members = list({
-                    d.metadata['member_id'] for d in model_data_items
-                    })
-
-                # Get the maximum number of members, if this parameter is
-                # not given just take an unlimited (1e9) number of members.
+            # Single pass: collect the members of every model.
+            model_members = {}
+            for d in data_items:
+                metadata = d.metadata
+                model_members.setdefault(
+                    metadata.source_id, set()).add(metadata.member_id)
+
+            # Select first X members of every model according to the
+            # member sorting algorithm.
+            selected_members = {}
+            for model, unq_members in model_members.items():
+                selected_members[model] = set(helper.sort_member_id_str(
+                    unq_members)[:max_number_of_members])
                 if max_number_of_members < len(unq_members):
-                    # Select first X of unq_members according to
-                    # member sorting algorithm
-                    selected_members = helper.sort_member_id_str(
-                        unq_members)[:max_number_of_members]
-                    model_data_items = [
-                        d for d in model_data_items
-                        if d.metadata['member_id'] in selected_members]
-                    unq_members2 = list(
-                        {d.metadata['member_id'] for d in model_data_items})
                     logger.debug(
                         f'Filtering of number of members ({model}) '
-                        f'{len(unq_members)} -> {len(unq_members)}.')
-
-                all_model_data_items.extend(model_data_items)
-            filtered_data_items = all_model_data_items
+                        f'{len(unq_members)} -> '
+                        f'{len(selected_members[model])}.')
+            filtered_data_items = [
+                d for d in data_items
+                if d.metadata.member_id in selected_members[
+                    d.metadata.source_id]]
 
         # More filtering could come here
         # .....
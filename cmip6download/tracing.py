@@ -0,0 +1,166 @@
+import contextlib
+import cProfile
+import json
+import multiprocessing.util
+import os
+from pathlib import Path
+import threading
+import time
+
+from cmip6download import helper
+
+
+logger = helper.get_logger(__file__)
+
+
+TRACE_FILE_PREFIX = 'trace.'
+CHROME_TRACE_FILENAME = 'trace.json'
+
+
+class Tracer:
+    """Writes spans of this process as JSON lines.
+
+    Every span is one Chrome trace event (complete event, ph X) written
+    as a line to trace.<run_id>.<pid>.jsonl in directory, so that all
+    processes can trace without coordination. merge_traces combines the
+    files of a run into a single trace, which can be opened in
+    chrome://tracing or https://ui.perfetto.dev.
+
+    Args:
+        directory (str or pathlib.Path): Directory of the trace files.
+        run_id (str): Shared by all processes of a run.
+
+    """
+    def __init__(self, directory, run_id):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def _get_file(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = open(
+                self.directory /
+                f'{TRACE_FILE_PREFIX}{self.run_id}.{self._pid}.jsonl',
+                'a', buffering=1)
+        return self._file
+
+    def write(self, name, start, duration, category=None, **args):
+        event = {
+            'name': name, 'cat': category or 'cmip6download', 'ph': 'X',
+            'ts': round(start * 1e6), 'dur': round(duration * 1e6),
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        line = json.dumps(event, default=str) + '\n'
+        with self._lock:
+            self._get_file().write(line)
+
+
+_tracer = None
+_profiler = None
+_profile_path = None
+
+
+def configure(directory, run_id=None):
+    """Enable tracing to directory (None disables tracing).
+
+    Args:
+        directory (str or pathlib.Path): Directory of the trace files.
+        run_id (str): Id of the run (default: a new id). Worker
+            processes must use the id of the main process (see
+            get_run_id), since pids are recycled between runs.
+
+    """
+    global _tracer
+    if run_id is None:
+        run_id = f'{time.strftime("%Y%m%d%H%M%S")}-{os.getpid()}'
+    _tracer = None if directory is None else Tracer(directory, run_id)
+
+
+def get_run_id():
+    """Return the run id of the trace files (None if not enabled)."""
+    return None if _tracer is None else _tracer.run_id
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+@contextlib.contextmanager
+def span(name, category=None, **args):
+    """Record the duration of the with block as span name.
+
+    Does nothing if tracing is not enabled. The yielded dict can be
+    used to add arguments to the span (e.g. results).
+
+    Example:
+        >>> with tracing.span('checksum', filename=filename):
+        ...     checksum = sha256_checksum_file(path)
+
+    """
+    if _tracer is None:
+        yield args
+        return
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield args
+    finally:
+        _tracer.write(
+            name, start, time.perf_counter() - t0, category=category, **args)
+
+
+def merge_traces(directory):
+    """Merge the trace files of all processes of this run.
+
+    The files of earlier runs in directory are ignored.
+
+    Returns:
+        pathlib.Path: Path of the Chrome trace.
+
+    """
+    directory = Path(directory)
+    events = []
+    pattern = f'{TRACE_FILE_PREFIX}{get_run_id()}.*.jsonl'
+    for f in sorted(directory.glob(pattern)):
+        with open(f, 'r') as fh:
+            for line in fh:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # Last line of a killed process
+                    continue
+    events.sort(key=lambda e: e['ts'])
+    path = directory / CHROME_TRACE_FILENAME
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    logger.info(f'Wrote trace of {len(events)} spans to {path}.')
+    return path
+
+
+def start_profile(directory, name):
+    """Profile this process with cProfile.
+
+    The stats are written once when the process exits (see
+    dump_profile).
+
+    """
+    global _profiler, _profile_path
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    _profile_path = Path(directory) / f'{name}.{os.getpid()}.prof'
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    # Unlike atexit, also run at the exit of pool workers
+    multiprocessing.util.Finalize(None, dump_profile, exitpriority=0)
+
+
+def dump_profile():
+    """Stop profiling and write the stats of this process."""
+    global _profiler
+    if _profiler is None:
+        return
+    _profiler.disable()
+    _profiler.dump_stats(_profile_path)
+    _profiler = None
@@ -23,4 +23,7 @@ setuptools.setup(
         'beautifulsoup4',
         'lxml',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
 )